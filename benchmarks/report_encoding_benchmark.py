@@ -0,0 +1,83 @@
+"""Compares the report encoders on a synthetic employees_by_department result
+
+The legacy path builds a RealDictRow per row, like RealDictCursor.fetchall,
+and runs json.dumps over the list. The new paths encode the plain tuples with
+api_commons.encode_cursor_rows in the rows and columns layouts. It only needs
+psycopg2 installed locally, no database.
+
+    python benchmarks/report_encoding_benchmark.py --rows 100000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from decimal import Decimal
+
+from psycopg2.extras import RealDictRow
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", "src", "online_pipeline", "lambdas"))
+from api_commons import encode_cursor_rows  # noqa: E402
+
+# name and type OID, as in cursor.description
+DESCRIPTION = [("department", 25), ("job", 25), ("Q1", 20), ("Q2", 20), ("Q3", 20), ("Q4", 1700)]
+
+
+class SyntheticCursor:
+    """Iterates prebuilt tuples and exposes a description, like a psycopg2 cursor"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.description = DESCRIPTION
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+def build_rows(rows):
+    return [
+        (f"Department {index % 12}", f"Job {index % 180}", index % 7, index % 5, index % 3, Decimal(index % 11))
+        for index in range(rows)
+    ]
+
+
+def legacy_encode(rows):
+    columns = [column[0] for column in DESCRIPTION]
+    result = []
+    for row in rows:
+        dict_row = RealDictRow()
+        for column, value in zip(columns, row):
+            dict_row[column] = value
+        result.append(dict_row)
+    return json.dumps(result, default=str)
+
+
+def measure(encode, rows, repetitions):
+    timings = []
+    for _ in range(repetitions):
+        started_at = time.perf_counter()
+        encode(rows)
+        timings.append(time.perf_counter() - started_at)
+    best = min(timings)
+    return {"best_seconds": best, "rows_per_second": len(rows) / best}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repetitions", type=int, default=5)
+    arguments = parser.parse_args()
+
+    rows = build_rows(arguments.rows)
+    paths = {
+        "RealDictRow + json.dumps": legacy_encode,
+        "tuples, rows layout": lambda rows: encode_cursor_rows(SyntheticCursor(rows), "json", layout="rows"),
+        "tuples, columns layout": lambda rows: encode_cursor_rows(SyntheticCursor(rows), "json", layout="columns")
+    }
+    for name, encode in paths.items():
+        result = measure(encode, rows, arguments.repetitions)
+        print(f"{name:<26} {result['rows_per_second']:>12.0f} rows/sec  best {result['best_seconds'] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -16,6 +16,7 @@ from aws_cdk import (
 )
 from constructs import Construct
 import os
+from iac.workflow_definition import build_workflow, DEFAULT_MAX_CONCURRENCY
 
 class GlobantChallengeStack(Stack):
 
@@ -99,6 +100,8 @@ class GlobantChallengeStack(Stack):
         self.raw_bucket.grant_read_write(self.processing_lambdas_role)
         
         self.pipelines_metadata.grant_read_write(iam.AccountRootPrincipal())
+        # Manifest of the raw files already loaded to staging
+        self.pipelines_metadata.grant_read_write(self.processing_lambdas_role)
         
 
     def create_target_database(self):
@@ -137,15 +140,19 @@ class GlobantChallengeStack(Stack):
             handler="source_to_raw.run",
             runtime=lambda_.Runtime.PYTHON_3_9,
             environment={
-                "TARGET_DB_CREDENTIALS_SECRET": secrets.Secret.from_secret_name_v2(self, "hr_db_scret", "hr").secret_arn
+                "TARGET_DB_CREDENTIALS_SECRET": secrets.Secret.from_secret_name_v2(self, "hr_db_scret", "hr").secret_arn,
+                "RAW_BUCKET": self.raw_bucket.bucket_name
             },
             role=self.source_to_raw_lambda_role,
+            # Large CSVs are split in memory, part by part
+            memory_size=1024,
             timeout=Duration.minutes(15)
         )
 
+        # Removals are not copied to raw, so they do not invoke the lambda
         hr_new_data_event = event_sources.S3EventSource(
             self.globant_hr_bucket,
-            events=[s3.EventType.OBJECT_CREATED, s3.EventType.OBJECT_REMOVED],
+            events=[s3.EventType.OBJECT_CREATED],
             filters=[s3.NotificationKeyFilter(prefix="hr/")]
         )
 
@@ -160,6 +167,16 @@ class GlobantChallengeStack(Stack):
             timeout=Duration.minutes(15)
         )
 
+        self.list_raw_files: lambda_.Function = lambda_.Function(self, "list_raw_files_lambda",
+            code=lambda_.Code.from_asset(os.path.join(".", "src", "batch_pipeline", "lambdas")),
+            handler="raw_to_staging_db.list_files",
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            role=self.processing_lambdas_role,
+            # Hashes the files sharing their size with another one, streaming them from S3
+            memory_size=512,
+            timeout=Duration.minutes(15)
+        )
+
     def create_staging_to_modeled_processing(self):
         self.staging_to_modeled: lambda_.Function = lambda_.Function(self, "staging_to_modeled_lambda",
             code=lambda_.Code.from_asset(os.path.join(".", "src", "batch_pipeline", "lambdas")),
@@ -172,69 +189,68 @@ class GlobantChallengeStack(Stack):
     def create_step_function(self):
         database_secret = self.hr_db_instance.secret.secret_arn
         source = self.raw_bucket.bucket_name
-        departments_payload = sfn.TaskInput.from_object({
-            "target_db_secret": database_secret,
-            "rds_secret_arn": self.rds_secret_arn,
-            "dataset": "departments",
-            "domain": "hr",
-            "source": source
-        })
-
-        jobs_payload = sfn.TaskInput.from_object({
-            "target_db_secret": database_secret,
-            "rds_secret_arn": self.rds_secret_arn,
-            "dataset": "jobs",
-            "domain": "hr",
-            "source": source
-        })
-
-        employees_payload = sfn.TaskInput.from_object({
-            "target_db_secret": database_secret,
-            "rds_secret_arn": self.rds_secret_arn,
-            "dataset": "hired_employees",
-            "domain": "hr",
-            "source": source
-        })
-
-        departments_to_stg_task = tasks.LambdaInvoke(
-            self,
-            "Load departments to staging",
-            lambda_function=self.raw_to_stg,
-            payload=departments_payload
-        )
-
-        jobs_to_stg_task= tasks.LambdaInvoke(
-            self,
-            "Load jobs to staging",
-            lambda_function=self.raw_to_stg,
-            payload=jobs_payload
-        )
-
-        employees_to_stg_task = tasks.LambdaInvoke(
-            self,
-            "Load employees to staging",
-            lambda_function=self.raw_to_stg,
-            payload=employees_payload
-        )
-
-        validate_data_pass = sfn.Pass(self, "Validate Data")
-
-        staging_to_modeled = tasks.LambdaInvoke(
-            self,
-            "Load staging to modeled",
-            lambda_function=self.staging_to_modeled,
-            payload=sfn.TaskInput.from_object({
-                "target_db_secret": database_secret
-            })
-        )
-
-        main_workflow = (
-            departments_to_stg_task
-            .next(jobs_to_stg_task)
-            .next(employees_to_stg_task)
-            .next(validate_data_pass)
-            .next(staging_to_modeled)
-        )
+        metadata_bucket = self.pipelines_metadata.bucket_name
+        # Files imported at the same time per dataset, cdk deploy -c raw_to_staging_max_concurrency=20
+        max_concurrency = int(self.node.try_get_context("raw_to_staging_max_concurrency") or DEFAULT_MAX_CONCURRENCY)
+        # The steps are shared with iac/local_workflow.py, see iac/workflow_definition.py
+        steps = build_workflow(database_secret, self.rds_secret_arn, source, metadata_bucket, max_concurrency)
+        handler_functions = {
+            "raw_to_staging_db.list_files": self.list_raw_files,
+            "raw_to_staging_db.run": self.raw_to_stg,
+            "staging_to_modeled.run": self.staging_to_modeled
+        }
+
+        def add_retry(task, retry):
+            if retry:
+                task.add_retry(
+                    errors=["States.ALL"],
+                    max_attempts=retry["max_attempts"],
+                    interval=Duration.seconds(retry["interval_seconds"]),
+                    backoff_rate=retry["backoff_rate"]
+                )
+            return task
+
+        def create_state(step):
+            if step["type"] == "task":
+                return add_retry(tasks.LambdaInvoke(
+                    self,
+                    step["name"],
+                    lambda_function=handler_functions[step["handler"]],
+                    payload=sfn.TaskInput.from_object(step["payload"]),
+                    payload_response_only=True
+                ), step.get("retry"))
+            if step["type"] == "map":
+                state = sfn.Map(
+                    self,
+                    step["name"],
+                    items_path=f"$.{step['items_field']}",
+                    max_concurrency=step["max_concurrency"],
+                    parameters={**step["payload"], f"{step['item_field']}.$": "$$.Map.Item.Value"},
+                    # The file reports are in the logs, the state payload stays small
+                    result_path=sfn.JsonPath.DISCARD
+                )
+                state.iterator(add_retry(tasks.LambdaInvoke(
+                    self,
+                    step["iterator_name"],
+                    lambda_function=handler_functions[step["handler"]],
+                    payload=sfn.TaskInput.from_json_path_at("$"),
+                    payload_response_only=True
+                ), step.get("retry")))
+                return state
+            if step["type"] == "parallel":
+                state = sfn.Parallel(self, step["name"], result_path=sfn.JsonPath.DISCARD)
+                for branch in step["branches"]:
+                    state.branch(create_chain(branch))
+                return state
+            return sfn.Pass(self, step["name"])
+
+        def create_chain(chain_steps):
+            chain = sfn.Chain.start(create_state(chain_steps[0]))
+            for step in chain_steps[1:]:
+                chain = chain.next(create_state(step))
+            return chain
+
+        main_workflow = create_chain(steps)
 
         self.state_machine = sfn.StateMachine(
             self,
@@ -304,7 +320,9 @@ class GlobantChallengeStack(Stack):
 
         reports_api = apigateway.LambdaRestApi(self, "reports_api",
             handler=start_report_execution,
-            proxy=False
+            proxy=False,
+            # Lets API Gateway decode the base64 gzip/br bodies returned by the reports lambda
+            binary_media_types=["*/*"]
         )
 
         employees_by_department_resource = reports_api.root.add_resource("employees_by_department")
@@ -0,0 +1,164 @@
+"""Runs the load_hr_database workflow in-process, without Step Functions
+
+The steps come from iac/workflow_definition.py, the same definition the stack
+deploys, and every task calls the handler of src/batch_pipeline/lambdas directly.
+Parallel branches and Map items run on threads and failed tasks are retried.
+A timing trace of every step is printed at the end and written to --trace.
+
+Point it at a local Postgres and an S3 stand-in (MinIO, moto_server) with a
+secrets file mapping the ARNs to their values, for example:
+
+    S3_ENDPOINT_URL=http://localhost:9000 python -m iac.local_workflow \\
+        --secrets-file local_secrets.json --set loader=copy --trace trace.json
+
+local_secrets.json:
+    {"local-hr-db": {"dbname": "hr", "username": "hr", "password": "hr", "host": "localhost", "port": 5432}}
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from iac.workflow_definition import build_workflow, DEFAULT_MAX_CONCURRENCY
+
+LAMBDAS_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "batch_pipeline", "lambdas")
+
+class LocalWorkflowRunner:
+
+    def __init__(self, overrides=None, retry_interval_seconds=None):
+        self.overrides = overrides or {}
+        # Replaces the interval of the retry policies, to retry faster on a laptop
+        self.retry_interval_seconds = retry_interval_seconds
+        self.started_at = None
+        self.trace = []
+
+    def run(self, steps, workflow_input=None):
+        self.started_at = time.monotonic()
+        self.trace = []
+        return self.run_steps(steps, workflow_input or {})
+
+    def run_steps(self, steps, step_input):
+        output = step_input
+        for step in steps:
+            output = self.run_step(step, output)
+        return output
+
+    def run_step(self, step, step_input):
+        started_at = time.monotonic()
+        entry = {"step": step["name"], "type": step["type"], "start": round(started_at - self.started_at, 3)}
+        try:
+            if step["type"] == "task":
+                payload = {**step["payload"], **self.overrides}
+                output, entry["attempts"] = self.invoke(step["handler"], payload, step.get("retry"))
+            elif step["type"] == "map":
+                output = self.run_map(step, step_input)
+                entry["items"] = len(output)
+            elif step["type"] == "parallel":
+                with ThreadPoolExecutor(max_workers=len(step["branches"])) as executor:
+                    output = list(executor.map(lambda branch: self.run_steps(branch, step_input), step["branches"]))
+            elif step["type"] == "pass":
+                output = step_input
+            else:
+                raise ValueError(f"Unknown step type {step['type']}")
+        except Exception as e:
+            entry["status"] = "failed"
+            entry["error"] = str(e)
+            raise e
+        else:
+            entry["status"] = "succeeded"
+        finally:
+            entry["seconds"] = round(time.monotonic() - started_at, 3)
+            self.trace.append(entry)
+        return output
+
+    def run_map(self, step, step_input):
+        items = step_input[step["items_field"]]
+
+        def run_item(item):
+            item_step = {
+                "type": "task",
+                "name": f"{step['iterator_name']} {item.get('key', '') if isinstance(item, dict) else item}".strip(),
+                "handler": step["handler"],
+                "payload": {**step["payload"], step["item_field"]: item},
+                "retry": step.get("retry")
+            }
+            return self.run_step(item_step, item)
+
+        with ThreadPoolExecutor(max_workers=max(1, min(step["max_concurrency"], len(items) or 1))) as executor:
+            return list(executor.map(run_item, items))
+
+    def invoke(self, handler, payload, retry=None):
+        """Calls module.function with the payload, retrying with backoff like the state machine
+
+        retry has the Step Functions fields of the task definition, a task
+        without it runs once.
+        """
+        module_name, function_name = handler.rsplit(".", 1)
+        function = getattr(importlib.import_module(module_name), function_name)
+        retry = retry or {"max_attempts": 0, "interval_seconds": 0, "backoff_rate": 1}
+        max_attempts = retry["max_attempts"] + 1
+        interval = retry["interval_seconds"] if self.retry_interval_seconds is None else self.retry_interval_seconds
+        backoff_rate = retry["backoff_rate"]
+        for attempt in range(1, max_attempts + 1):
+            try:
+                return function(json.loads(json.dumps(payload)), None), attempt
+            except Exception as e:
+                if attempt == max_attempts:
+                    raise e
+                print(f"{handler} failed on attempt {attempt}, retrying in {interval}s: {e}")
+                traceback.print_exc()
+                time.sleep(interval)
+                interval *= backoff_rate
+
+def parse_overrides(assignments):
+    overrides = {}
+    for assignment in assignments or []:
+        name, separator, value = assignment.partition("=")
+        if not separator:
+            raise argparse.ArgumentTypeError(f"--set expects name=value, got {assignment}")
+        try:
+            overrides[name] = json.loads(value)
+        except ValueError:
+            overrides[name] = value
+    return overrides
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-secret", default="local-hr-db", help="ARN or key of the database secret")
+    parser.add_argument("--rds-secret-arn", default="local-rds-import", help="ARN or key of the aws_s3 import keys")
+    parser.add_argument("--source", default="raw-globant-hr", help="Raw bucket")
+    parser.add_argument("--metadata-bucket", default="pipelines-metadata-globant")
+    parser.add_argument("--max-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY)
+    parser.add_argument("--secrets-file", help="JSON file mapping secret ARNs to their values")
+    parser.add_argument("--set", action="append", dest="overrides", metavar="NAME=VALUE",
+                        help="Added to every task payload, e.g. loader=copy or local_metadata_dir=/tmp/metadata")
+    parser.add_argument("--retry-interval-seconds", type=float,
+                        help="Replaces the interval of the retry policies of the workflow")
+    parser.add_argument("--trace", help="Writes the timing trace to this JSON file")
+    args = parser.parse_args()
+
+    if args.secrets_file:
+        # Read by database_commons when the handlers are imported
+        os.environ["LOCAL_SECRETS_FILE"] = os.path.abspath(args.secrets_file)
+    # Appended, so the locally installed psycopg2 wins over the one vendored for Lambda
+    sys.path.append(LAMBDAS_DIR)
+
+    steps = build_workflow(args.database_secret, args.rds_secret_arn, args.source, args.metadata_bucket,
+                           args.max_concurrency)
+    runner = LocalWorkflowRunner(parse_overrides(args.overrides), retry_interval_seconds=args.retry_interval_seconds)
+    try:
+        runner.run(steps)
+    finally:
+        trace = sorted(runner.trace, key=lambda entry: entry["start"])
+        for entry in trace:
+            print(f"{entry['start']:>9.3f}s {entry['seconds']:>9.3f}s  {entry['status']:<9} {entry['step']}")
+        if args.trace:
+            with open(args.trace, "w") as trace_file:
+                json.dump(trace, trace_file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Steps and payloads of the load_hr_database state machine. The stack turns them into
+# Step Functions states and iac/local_workflow.py runs them in-process, so both
+# always run the same workflow. Plain data only, no CDK imports.
+
+DOMAIN = "hr"
+# (dataset, name used in the state names)
+DATASETS = [
+    ("departments", "departments"),
+    ("jobs", "jobs"),
+    ("hired_employees", "employees")
+]
+DEFAULT_MAX_CONCURRENCY = 10
+# Retries of a failed task, with the Step Functions meaning: max_attempts retries
+# after the first attempt, interval_seconds multiplied by backoff_rate every time
+TASK_RETRY = {"max_attempts": 2, "interval_seconds": 10, "backoff_rate": 2}
+
+def get_dataset_payload(dataset, database_secret, rds_secret_arn, source, metadata_bucket):
+    return {
+        "target_db_secret": database_secret,
+        "rds_secret_arn": rds_secret_arn,
+        "dataset": dataset,
+        "domain": DOMAIN,
+        "source": source,
+        "metadata_bucket": metadata_bucket
+    }
+
+def build_workflow(database_secret, rds_secret_arn, source, metadata_bucket, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """Returns the steps of the workflow in order
+
+    Steps are dicts with a type and a name:
+      task      runs handler ("module.function") with payload, retried as in retry
+      map       runs handler once per item of the items_field list in the previous
+                output, with the item under item_field in payload
+      parallel  runs each list of steps in branches at the same time
+      pass      does nothing
+    """
+    branches = []
+    for dataset, name in DATASETS:
+        payload = get_dataset_payload(dataset, database_secret, rds_secret_arn, source, metadata_bucket)
+        branches.append([
+            {
+                "type": "task",
+                "name": f"List new {name} files",
+                "handler": "raw_to_staging_db.list_files",
+                "payload": payload,
+                "retry": TASK_RETRY
+            },
+            {
+                "type": "map",
+                "name": f"Load {name} files to staging",
+                "iterator_name": f"Load {name} file to staging",
+                "handler": "raw_to_staging_db.run",
+                "payload": payload,
+                "items_field": "files",
+                "item_field": "file",
+                "max_concurrency": max_concurrency,
+                "retry": TASK_RETRY
+            }
+        ])
+    return [
+        {"type": "parallel", "name": "Load datasets to staging", "branches": branches},
+        {"type": "pass", "name": "Validate Data"},
+        {
+            "type": "task",
+            "name": "Load staging to modeled",
+            "handler": "staging_to_modeled.run",
+            "payload": {"target_db_secret": database_secret},
+            # Resumes from the checkpoints of the failed attempt, the staging loads are not repeated
+            "retry": TASK_RETRY
+        }
+    ]
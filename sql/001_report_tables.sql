@@ -0,0 +1,46 @@
+-- Pre-aggregated hire counts read by the reports API.
+-- Kept up to date by staging_to_modeled.run in the same transaction as the
+-- hired_employees writes, the inserts below backfill them. Only dated hires are
+-- counted, POST /employees rows only reach sql/006_report_total_hires.sql.
+
+create table if not exists report_hires_by_department_job_quarter (
+    department_id integer not null,
+    job_id integer not null,
+    year integer not null,
+    quarter integer not null,
+    hired bigint not null,
+    primary key (department_id, job_id, year, quarter)
+);
+
+create table if not exists report_hires_by_department_year (
+    department_id integer not null,
+    year integer not null,
+    hired bigint not null,
+    primary key (department_id, year)
+);
+
+insert into report_hires_by_department_job_quarter (department_id, job_id, year, quarter, hired)
+    select
+        department_id,
+        job_id,
+        extract(year from hired_datetime)::integer,
+        extract(quarter from hired_datetime)::integer,
+        count(*)
+    from hired_employees
+    where hired_datetime is not null and department_id is not null and job_id is not null
+    group by 1, 2, 3, 4
+on conflict (department_id, job_id, year, quarter) do
+update
+    set hired = EXCLUDED.hired;
+
+insert into report_hires_by_department_year (department_id, year, hired)
+    select
+        department_id,
+        extract(year from hired_datetime)::integer,
+        count(*)
+    from hired_employees
+    where hired_datetime is not null and department_id is not null
+    group by 1, 2
+on conflict (department_id, year) do
+update
+    set hired = EXCLUDED.hired;
@@ -0,0 +1,11 @@
+-- Version counter bumped by every transaction that writes hired_employees.
+-- The reports API uses it to invalidate cached responses and build ETags.
+
+create table if not exists data_versions (
+    name text primary key,
+    version bigint not null,
+    updated_at timestamptz not null default now()
+);
+
+insert into data_versions (name, version) values ('hired_employees', 1)
+on conflict (name) do nothing;
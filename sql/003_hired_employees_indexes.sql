@@ -0,0 +1,6 @@
+-- Supports the date range filters of the reports API, which query
+-- hired_employees directly when the period is not a whole year.
+-- Built concurrently so loads are not blocked, run it outside a transaction.
+
+create index concurrently if not exists hired_employees_hired_datetime_department_job_idx
+    on hired_employees (hired_datetime, department_id, job_id);
@@ -0,0 +1,16 @@
+-- Progress of the chunked merge in staging_to_modeled.run. A chunk commits its
+-- checkpoint with its rows, so a failed run resumes after the last merged id.
+-- A checkpoint is only reused while the staging table keeps the row count it was
+-- taken with, otherwise the merge starts over, which is safe since it is an upsert.
+
+create table if not exists staging_merge_checkpoints (
+    dataset text primary key,
+    last_id bigint not null,
+    staging_rows bigint not null,
+    updated_at timestamptz not null default now()
+);
+
+-- Every chunk reads one id range of the staging tables
+create index if not exists staging_departments_id_idx on staging_departments (id);
+create index if not exists staging_jobs_id_idx on staging_jobs (id);
+create index if not exists staging_hired_employees_id_idx on staging_hired_employees (id);
@@ -0,0 +1,31 @@
+-- Ledger of the staging_to_modeled runs. A run is inserted as running, every merged
+-- chunk adds its statement row in the same transaction as the chunk, and the run is
+-- closed as succeeded with the staging cleanup or as failed with the error.
+
+create table if not exists staging_to_modeled_runs (
+    run_id text primary key,
+    status text not null,
+    started_at timestamptz not null default now(),
+    finished_at timestamptz,
+    rows bigint,
+    inserted bigint,
+    updated bigint,
+    unchanged bigint,
+    error text
+);
+
+create table if not exists staging_to_modeled_run_statements (
+    run_id text not null references staging_to_modeled_runs (run_id),
+    statement text not null,
+    dataset text,
+    after_id bigint,
+    until_id bigint,
+    rows bigint,
+    inserted bigint,
+    updated bigint,
+    seconds double precision not null,
+    recorded_at timestamptz not null default now()
+);
+
+create index if not exists staging_to_modeled_run_statements_run_id_idx
+    on staging_to_modeled_run_statements (run_id);
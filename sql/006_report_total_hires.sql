@@ -0,0 +1,34 @@
+-- All-time hire counts read by the above average departments report. Unlike the
+-- yearly tables they also count the employees without hired_datetime, such as the
+-- ones created by POST /employees, as the original report did.
+-- Kept up to date by staging_to_modeled.run and POST /employees, the inserts below backfill them.
+
+create table if not exists report_total_hires_by_department (
+    department_id integer primary key,
+    hired bigint not null
+);
+
+create table if not exists report_total_hires_by_department_job (
+    department_id integer not null,
+    job_id integer not null,
+    hired bigint not null,
+    primary key (department_id, job_id)
+);
+
+insert into report_total_hires_by_department (department_id, hired)
+    select department_id, count(*)
+    from hired_employees
+    where department_id is not null
+    group by 1
+on conflict (department_id) do
+update
+    set hired = EXCLUDED.hired;
+
+insert into report_total_hires_by_department_job (department_id, job_id, hired)
+    select department_id, job_id, count(*)
+    from hired_employees
+    where department_id is not null and job_id is not null
+    group by 1, 2
+on conflict (department_id, job_id) do
+update
+    set hired = EXCLUDED.hired;
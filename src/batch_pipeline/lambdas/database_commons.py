@@ -1,21 +1,43 @@
 import json
+import time
 import boto3
 import base64
 import psycopg2
 from datetime import datetime
 from botocore.exceptions import ClientError
+import os
 
-def _get_database_secret(event):
-    target_db_secret_arn = event.get("target_db_secret")
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name='us-west-2'
-    )
+# Secrets are cached per warm container, keyed by the secret ARN
+SECRET_CACHE_TTL_SECONDS = int(os.getenv("SECRET_CACHE_TTL_SECONDS", "300"))
+secret_cache_stats = {"hits": 0, "misses": 0}
+_secrets_cache = {}
+_secrets_client = None
+# JSON file mapping secret ARNs to their values, used instead of Secrets Manager for local runs
+LOCAL_SECRETS_FILE = os.getenv("LOCAL_SECRETS_FILE")
+
+def _get_secrets_client():
+    global _secrets_client
+    if not _secrets_client:
+        session = boto3.session.Session()
+        _secrets_client = session.client(
+            service_name='secretsmanager',
+            region_name='us-west-2'
+        )
+    return _secrets_client
+
+def _read_local_secret(secret_arn):
+    with open(LOCAL_SECRETS_FILE) as secrets_file:
+        return json.load(secrets_file).get(secret_arn)
 
+def _fetch_secret(secret_arn):
+    if LOCAL_SECRETS_FILE:
+        local_secret = _read_local_secret(secret_arn)
+        if local_secret is not None:
+            return local_secret
+    client = _get_secrets_client()
     try:
         get_secret_value_response = client.get_secret_value(
-            SecretId=target_db_secret_arn
+            SecretId=secret_arn
         )
     except ClientError as e:
         raise e
@@ -24,17 +46,46 @@ def _get_database_secret(event):
             secret = get_secret_value_response['SecretString']
         else:
             secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-    
-    database_secret = json.loads(secret)
-    return database_secret
 
-def get_db_connection(event):
-    database_secret = _get_database_secret(event)
-    connection = psycopg2.connect(
+    return json.loads(secret)
+
+def get_secret(secret_arn, force_refresh=False):
+    cached_secret = _secrets_cache.get(secret_arn)
+    is_fresh = cached_secret and time.monotonic() - cached_secret["fetched_at"] < SECRET_CACHE_TTL_SECONDS
+    if is_fresh and not force_refresh:
+        secret_cache_stats["hits"] += 1
+        return cached_secret["secret"]
+
+    secret_cache_stats["misses"] += 1
+    secret = _fetch_secret(secret_arn)
+    _secrets_cache[secret_arn] = {"secret": secret, "fetched_at": time.monotonic()}
+    return secret
+
+def _get_database_secret(event, force_refresh=False):
+    target_db_secret_arn = event.get("target_db_secret")
+    return get_secret(target_db_secret_arn, force_refresh=force_refresh)
+
+def _is_authentication_error(error):
+    return "authentication failed" in str(error)
+
+def _connect(database_secret):
+    return psycopg2.connect(
         database=database_secret['dbname'],
         user=database_secret['username'],
         password=database_secret['password'],
         host=database_secret['host'],
         port=database_secret['port']
     )
-    return connection
\ No newline at end of file
+
+def get_db_connection(event):
+    database_secret = _get_database_secret(event)
+    try:
+        connection = _connect(database_secret)
+    except psycopg2.OperationalError as e:
+        if not _is_authentication_error(e):
+            raise e
+        # The cached secret may be stale after a rotation, fetch it again and retry once
+        print("Database authentication failed, refreshing the cached secret")
+        database_secret = _get_database_secret(event, force_refresh=True)
+        connection = _connect(database_secret)
+    return connection
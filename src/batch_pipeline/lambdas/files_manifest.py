@@ -0,0 +1,107 @@
+import os
+import hashlib
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from s3_commons import S3_MOVE_PARALLELISM
+
+# Ledger of the raw files already handed to staging, per source bucket and dataset:
+#   <prefix>/watermark.json         first key still pending in the last listing, or its last key
+#   <prefix>/objects/<sha1>.json    key, ETag, size and status of every handled and moved file
+#   <prefix>/contents/<sha256>.json first file imported with that content
+# Keys written by source_to_raw start with their event time, but a retried or long copy
+# can land after later keys. Listings start RAW_LISTING_LAG_SECONDS of key time before
+# the watermark and the ledger skips the files already handled.
+RAW_LISTING_LAG_SECONDS = int(os.getenv("RAW_LISTING_LAG_SECONDS", str(6 * 60 * 60)))
+RAW_KEY_TIME_FORMAT = "%Y%m%dT%H%M%S"
+
+def get_manifest_prefix(event):
+    return f"manifests/{event['source']}/{event['domain']}/{event['dataset']}"
+
+def _get_entry_key(event, file_key):
+    return f"{get_manifest_prefix(event)}/objects/{hashlib.sha1(file_key.encode('utf-8')).hexdigest()}.json"
+
+def read_watermark(store, event):
+    watermark = store.read_json(f"{get_manifest_prefix(event)}/watermark.json") or {}
+    return watermark.get("start_after")
+
+def write_watermark(store, event, start_after):
+    store.write_json(f"{get_manifest_prefix(event)}/watermark.json", {
+        "start_after": start_after,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    })
+
+def _parse_key_time(name):
+    """Event time at the start of a raw file name, like 20240101T101500123Z-departments.csv"""
+    try:
+        key_time = datetime.strptime(name[:15], RAW_KEY_TIME_FORMAT)
+        milliseconds = int(name[15:18])
+    except ValueError:
+        return None
+    return key_time.replace(microsecond=milliseconds * 1000)
+
+def get_listing_start_after(prefix, watermark, lag_seconds=RAW_LISTING_LAG_SECONDS):
+    """StartAfter for listing prefix, lag_seconds of key time before the watermark
+
+    None lists the whole prefix, also when the watermark does not start with a key time.
+    """
+    if not watermark or not watermark.startswith(prefix):
+        return None
+    key_time = _parse_key_time(watermark[len(prefix):])
+    if key_time is None:
+        return None
+    start_time = key_time - timedelta(seconds=lag_seconds)
+    return f"{prefix}{start_time.strftime(RAW_KEY_TIME_FORMAT)}{start_time.microsecond // 1000:03d}Z"
+
+def is_already_handled(store, event, s3_object):
+    """True when the same key and ETag were handled and moved by a previous run"""
+    entry = store.read_json(_get_entry_key(event, s3_object["key"]))
+    return bool(entry) and entry["etag"] == s3_object["etag"]
+
+def record_handled_files(store, event, file_reports, s3_objects):
+    """Writes the ledger entry of every handled file that was moved
+
+    Files still in unprocessed are left out, so the next run lists them again and
+    retries the move. Their content entry keeps them from being imported twice.
+    """
+    objects_by_key = {s3_object["key"]: s3_object for s3_object in s3_objects}
+    handled_at = datetime.now(timezone.utc).isoformat()
+    file_reports = [file_report for file_report in file_reports if file_report.get("moved")]
+
+    def write_entry(file_report):
+        s3_object = objects_by_key[file_report["file"]]
+        store.write_json(_get_entry_key(event, s3_object["key"]), {
+            "key": s3_object["key"],
+            "etag": s3_object["etag"],
+            "size": s3_object["size"],
+            "status": file_report["status"],
+            "handled_at": handled_at
+        })
+
+    if not file_reports:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(S3_MOVE_PARALLELISM, len(file_reports)))) as executor:
+        list(executor.map(write_entry, file_reports))
+
+def _get_content_key(event, content_hash):
+    return f"{get_manifest_prefix(event)}/contents/{content_hash}.json"
+
+def find_imported_content(store, event, content_hash):
+    """Returns the key of the file already imported with this content, or None"""
+    entry = store.read_json(_get_content_key(event, content_hash))
+    return entry["key"] if entry else None
+
+def record_imported_contents(store, event, file_reports):
+    """Indexes the content hash of the imported files, failed imports stay retryable"""
+    imported_at = datetime.now(timezone.utc).isoformat()
+    imported_file_reports = [file_report for file_report in file_reports if file_report["status"] == "processed"]
+
+    def write_entry(file_report):
+        store.write_json(_get_content_key(event, file_report["content_hash"]), {
+            "key": file_report["file"],
+            "imported_at": imported_at
+        })
+
+    if not imported_file_reports:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, min(S3_MOVE_PARALLELISM, len(imported_file_reports)))) as executor:
+        list(executor.map(write_entry, imported_file_reports))
@@ -0,0 +1,58 @@
+import os
+import json
+import threading
+from botocore.exceptions import ClientError
+from s3_commons import get_s3_client
+
+# Pipeline bookkeeping lives in the metadata bucket, or in a local directory
+# standing in for it when the event or PIPELINE_METADATA_DIR sets one
+DEFAULT_METADATA_BUCKET = os.getenv("PIPELINE_METADATA_BUCKET", "pipelines-metadata-globant")
+PIPELINE_METADATA_DIR = os.getenv("PIPELINE_METADATA_DIR")
+
+class S3MetadataStore:
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+    def read_json(self, key):
+        try:
+            response = get_s3_client().get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise e
+        return json.loads(response["Body"].read())
+
+    def write_json(self, key, data):
+        get_s3_client().put_object(
+            Bucket=self.bucket,
+            Key=key,
+            Body=json.dumps(data).encode("utf-8"),
+            ContentType="application/json"
+        )
+
+class LocalMetadataStore:
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def read_json(self, key):
+        try:
+            with open(os.path.join(self.directory, key)) as metadata_file:
+                return json.load(metadata_file)
+        except FileNotFoundError:
+            return None
+
+    def write_json(self, key, data):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temporary_path, "w") as metadata_file:
+            json.dump(data, metadata_file)
+        os.replace(temporary_path, path)
+
+def get_metadata_store(event):
+    local_directory = event.get("local_metadata_dir", PIPELINE_METADATA_DIR)
+    if local_directory:
+        return LocalMetadataStore(local_directory)
+    return S3MetadataStore(event.get("metadata_bucket", DEFAULT_METADATA_BUCKET))
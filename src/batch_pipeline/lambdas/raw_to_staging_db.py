@@ -1,105 +1,400 @@
+import os
+import re
 import json
-import boto3
-import base64
-from database_commons import get_db_connection
+import time
+import hashlib
+import threading
+from contextlib import closing
+from psycopg2 import sql
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from database_commons import get_db_connection, get_secret
+from s3_commons import get_s3_client, move_objects
+from metadata_store import get_metadata_store
+from files_manifest import (
+    read_watermark,
+    write_watermark,
+    get_listing_start_after,
+    is_already_handled,
+    record_handled_files,
+    find_imported_content,
+    record_imported_contents
+)
+
+# Files imported at the same time, each worker thread uses its own connection
+RAW_TO_STAGING_PARALLELISM = int(os.getenv("RAW_TO_STAGING_PARALLELISM", "4"))
+_worker_state = threading.local()
+COPY_BUFFER_SIZE = int(os.getenv("COPY_BUFFER_SIZE", str(1024 * 1024)))
+# S3 errors reported by aws_s3.table_import_from_s3 when the import keys are rejected
+S3_ACCESS_DENIED_ERRORS = ("AccessDenied", "InvalidAccessKeyId", "SignatureDoesNotMatch", "ExpiredToken", "HTTP 403")
+HASH_BUFFER_SIZE = 1024 * 1024
+# S3 error codes that mean the raw file cannot be read, other errors while hashing are
+# treated as transient and the file is left in unprocessed for the next run
+UNREADABLE_FILE_ERRORS = ("NoSuchKey", "404", "AccessDenied", "403")
 
 def run(event, _):
-    connection = None
+    started_at = time.monotonic()
+    store = get_metadata_store(event)
+    # The Map state of the load_hr_database state machine sends one file per invocation
+    new_files = get_event_files(event, store) if "file" in event else discover_new_files(event, store)
+    parallelism = max(1, min(int(event.get("parallelism", RAW_TO_STAGING_PARALLELISM)), len(new_files) or 1))
+    # Files listed by list_files that share their size with another file were hashed there already
+    content_hashes = {s3_object["key"]: s3_object.get("content_hash") for s3_object in new_files}
+    unique_files, skipped_file_reports = split_duplicate_files(
+        event, store, [s3_object["key"] for s3_object in new_files], parallelism, content_hashes
+    )
+    # Resolved once per run and shared by every file import, COPY reads the files itself
+    s3_import_credentials = get_s3_import_credentials(event) if get_loader_name(event) == "aws_s3" else None
+    objects_by_key = {s3_object["key"]: s3_object for s3_object in new_files}
+    opened_connections = []
     try:
-        unprocessed_files = get_unprocessed_files(event)
-        connection = get_db_connection(event)
-        for unprocessed_file_path in unprocessed_files:
-            process_file(event, unprocessed_file_path, connection)
-        
-    except Exception as e:
-        raise e
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            file_reports = list(executor.map(
+                lambda unique_file: process_file_in_worker(
+                    event, store, objects_by_key[unique_file[0]], unique_file[1], s3_import_credentials,
+                    opened_connections
+                ),
+                unique_files
+            ))
     finally:
-        if connection:
+        for connection in opened_connections:
             connection.close()
+    # The contents were indexed by the workers right after their commits, so the
+    # moves are batched and a crash before them never imports a file twice
+    finish_files(
+        event, store,
+        file_reports + [file_report for file_report in skipped_file_reports if file_report["status"] != "deferred"],
+        new_files, record_contents=False
+    )
+    file_reports += skipped_file_reports
+
+    total_seconds = time.monotonic() - started_at
+    total_rows = sum(file_report["rows"] for file_report in file_reports)
+    report = {
+        "dataset": event["dataset"],
+        "loader": get_loader_name(event),
+        "parallelism": parallelism,
+        "processed": sum(1 for file_report in file_reports if file_report["status"] == "processed"),
+        "failed": sum(1 for file_report in file_reports if file_report["status"] == "failed"),
+        "duplicates": sum(1 for file_report in file_reports if file_report["status"] == "duplicate"),
+        "deferred": sum(1 for file_report in file_reports if file_report["status"] == "deferred"),
+        "not_moved": sum(
+            1 for file_report in file_reports if file_report["status"] != "deferred" and not file_report["moved"]
+        ),
+        "rows": total_rows,
+        "total_seconds": round(total_seconds, 3),
+        "rows_per_second": round(total_rows / total_seconds) if total_seconds else None,
+        "files": file_reports
+    }
+    print(json.dumps(report))
+    return report
 
-def process_file(event, file_path, db_connection):
+def get_worker_connection(event, opened_connections):
+    connection = getattr(_worker_state, "connection", None)
+    if connection is None or connection.closed:
+        connection = get_db_connection(event)
+        _worker_state.connection = connection
+        opened_connections.append(connection)
+    return connection
+
+def compute_content_hash(event, file_path):
+    digest = hashlib.sha256()
+    with open_file_stream(event, file_path) as file_stream:
+        for chunk in iter(lambda: file_stream.read(HASH_BUFFER_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _is_unreadable_file_error(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in UNREADABLE_FILE_ERRORS
+    return isinstance(error, (FileNotFoundError, PermissionError))
+
+def _hash_and_find_duplicate(event, store, file_path, content_hash=None):
     try:
-        key_id, secret_key = get_s3_import_credentials(event)
-        import_query = f"""
-        select aws_s3.table_import_from_s3 (
-            'staging_{event['dataset']}', 
-            '',
-            '(format csv, header false)',
-            '{event['source']}', 
-            '{file_path}', 
-            'us-west-2',
-            '{key_id}',
-            '{secret_key}'
-        )
-        """
+        content_hash = content_hash or compute_content_hash(event, file_path)
+        return content_hash, find_imported_content(store, event, content_hash), None
+    except Exception as e:
+        return None, None, e
+
+def split_duplicate_files(event, store, file_paths, parallelism, content_hashes=None):
+    """Separates the files whose content was already imported, before any database work
+
+    Returns the (file_path, content_hash) pairs to import and the reports of the
+    skipped files: duplicates of an imported file or of an earlier file of this
+    run, files that could not be read, and files imported by a previous run that
+    could not be moved then, which are only moved to processed. Files hit by a
+    transient error are reported as deferred and left for the next run.
+    content_hashes maps the paths already hashed to their hash.
+    """
+    content_hashes = content_hashes or {}
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        hashes = list(executor.map(
+            lambda file_path: _hash_and_find_duplicate(event, store, file_path, content_hashes.get(file_path)),
+            file_paths
+        ))
+
+    unique_files = []
+    skipped_file_reports = []
+    files_by_hash = {}
+    for file_path, (content_hash, imported_file_path, error) in zip(file_paths, hashes):
+        duplicate_of = imported_file_path or files_by_hash.get(content_hash)
+        if error and _is_unreadable_file_error(error):
+            print(f"File {file_path} could not be read, sending it to failed: {error}")
+            skipped_file_reports.append(build_file_report(event, file_path, "failed", content_hash))
+        elif error:
+            print(f"File {file_path} not hashed, leaving it for the next run: {error}")
+            file_report = build_file_report(event, file_path, "deferred", content_hash)
+            file_report["error"] = str(error)
+            skipped_file_reports.append(file_report)
+        elif duplicate_of == file_path:
+            print(f"File {file_path} was already imported, moving it to processed")
+            file_report = build_file_report(event, file_path, "processed", content_hash)
+            file_report["already_imported"] = True
+            skipped_file_reports.append(file_report)
+        elif duplicate_of:
+            print(f"File {file_path} has the same content as {duplicate_of}, skipping it")
+            file_report = build_file_report(event, file_path, "duplicate", content_hash)
+            file_report["duplicate_of"] = duplicate_of
+            skipped_file_reports.append(file_report)
+        else:
+            files_by_hash[content_hash] = file_path
+            unique_files.append((file_path, content_hash))
+    return unique_files, skipped_file_reports
+
+def build_file_report(event, file_path, status, content_hash, rows=0, seconds=0.0):
+    return {
+        "file": file_path,
+        "status": status,
+        "content_hash": content_hash,
+        "loader": get_loader_name(event),
+        "rows": rows,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds) if seconds else None
+    }
+
+def process_file_in_worker(event, store, s3_object, content_hash, s3_import_credentials, opened_connections):
+    """Imports one file and indexes its content right after its commit, so a later crash never imports it twice
+
+    A file left in unprocessed by a crash is then moved to processed by the next
+    run, as already imported, see split_duplicate_files.
+    """
+    started_at = time.monotonic()
+    db_connection = get_worker_connection(event, opened_connections)
+    status, rows = process_file(event, s3_object["key"], db_connection, s3_import_credentials)
+    file_report = build_file_report(event, s3_object["key"], status, content_hash, rows, time.monotonic() - started_at)
+    record_imported_contents(store, event, [file_report])
+    return file_report
+
+def finish_files(event, store, file_reports, s3_objects, record_contents=True):
+    """Moves the handled files out of unprocessed, then records them in the content index and the ledger
+
+    record_contents=False is for files whose content was indexed already.
+    """
+    move_report = move_files(event["source"], file_reports)
+    if record_contents:
+        record_imported_contents(store, event, file_reports)
+    record_handled_files(store, event, file_reports, s3_objects)
+    return move_report
+
+def import_with_aws_s3(event, file_path, db_connection, s3_import_credentials):
+    """Imports with the RDS aws_s3 extension, the database reads the object from S3 itself"""
+    key_id, secret_key = s3_import_credentials or get_s3_import_credentials(event)
+    import_query = """
+    select aws_s3.table_import_from_s3 (
+        %s,
+        '',
+        '(format csv, header false)',
+        %s,
+        %s,
+        'us-west-2',
+        %s,
+        %s
+    )
+    """
+    with db_connection.cursor() as cursor:
+        print(f"Importing {file_path} with aws_s3.table_import_from_s3")
+        cursor.execute(import_query, (f"staging_{event['dataset']}", event['source'], file_path, key_id, secret_key))
+        result = cursor.fetchone()[0]
+    # The extension answers with a message like "500 rows imported into relation ..."
+    imported_rows = re.match(r"\s*(\d+)", result or "")
+    return int(imported_rows.group(1)) if imported_rows else 0
+
+def open_file_stream(event, file_path):
+    """Opens the raw file as a stream, from local_source_dir when the event sets it"""
+    if event.get("local_source_dir"):
+        return open(os.path.join(event["local_source_dir"], file_path), "rb")
+    response = get_s3_client().get_object(Bucket=event["source"], Key=file_path)
+    return closing(response["Body"])
+
+def import_with_copy(event, file_path, db_connection, s3_import_credentials=None):
+    """Streams the file body into COPY FROM STDIN, COPY_BUFFER_SIZE bytes at a time"""
+    copy_query = sql.SQL("COPY {} FROM STDIN WITH (FORMAT csv, HEADER false)").format(
+        sql.Identifier(f"staging_{event['dataset']}")
+    )
+    with open_file_stream(event, file_path) as file_stream:
         with db_connection.cursor() as cursor:
-            print(import_query)
-            cursor.execute(import_query)
+            print(f"Importing {file_path} with COPY FROM STDIN")
+            cursor.copy_expert(copy_query, file_stream, size=COPY_BUFFER_SIZE)
+            return cursor.rowcount
+
+STAGING_LOADERS = {
+    "aws_s3": import_with_aws_s3,
+    "copy": import_with_copy
+}
+
+def get_loader_name(event):
+    loader_name = event.get("loader", "aws_s3")
+    if loader_name not in STAGING_LOADERS:
+        raise ValueError(f"Unknown loader {loader_name}, use one of {', '.join(STAGING_LOADERS)}")
+    return loader_name
+
+def _is_access_denied_error(error):
+    return any(code in str(error) for code in S3_ACCESS_DENIED_ERRORS)
+
+def load_file(event, file_path, db_connection, s3_import_credentials=None):
+    loader_name = get_loader_name(event)
+    load = STAGING_LOADERS[loader_name]
+    try:
+        return load(event, file_path, db_connection, s3_import_credentials)
+    except Exception as e:
+        if loader_name != "aws_s3" or not _is_access_denied_error(e):
+            raise e
+        # The cached import keys may be stale after a rotation, fetch them again and retry once
+        print(f"S3 access denied importing {file_path}, refreshing the cached import keys")
+        db_connection.rollback()
+        return load(event, file_path, db_connection, get_s3_import_credentials(event, force_refresh=True))
+
+def process_file(event, file_path, db_connection, s3_import_credentials=None):
+    """Loads one file into its staging table, returns the status and the number of rows loaded"""
+    try:
+        rows = load_file(event, file_path, db_connection, s3_import_credentials)
         db_connection.commit()
     except Exception as e:
         print(f"File {file_path} not processed, sending it to failed, skipping it")
         print(e)
-        move_file_to(bucket=event['source'], file_path=file_path, to="failed")
+        try:
+            # Leaves the worker connection usable for its next file
+            db_connection.rollback()
+        except Exception as rollback_error:
+            # The failure may have closed the connection, the next file of the worker opens a new one
+            print(f"File {file_path} not rolled back, dropping the worker connection: {rollback_error}")
+            if getattr(_worker_state, "connection", None) is db_connection:
+                _worker_state.connection = None
+        return "failed", 0
     else:
-        move_file_to(bucket=event['source'], file_path=file_path, to="processed")
+        return "processed", rows
 
-def get_unprocessed_files(event):
-    try:
-        
-        client = boto3.client("s3")
-        paginator = client.get_paginator('list_objects')
-        operation_parameters = {'Bucket': event['source'],
-                                'Prefix': f"{event['domain']}/{event['dataset']}/unprocessed"
-                                }
-        page_iterator = paginator.paginate(**operation_parameters)
-        objects_list = []
-        for page in page_iterator:
-            if "Contents" in page:
-                contents = page["Contents"]
-                for dataset_object in contents:
-                    if ".csv" in dataset_object["Key"]:
-                        objects_list.append(dataset_object["Key"])
-            else:
-                print("No objects found")
-        print(objects_list)
-        return objects_list
+def discover_new_files(event, store):
+    """Lists the unprocessed csv files from a lag window before the manifest watermark
 
-    except Exception as e:
-        print(e)
-        raise e
-
-def get_s3_import_credentials(event):
-    rds_secret_arn = event.get("rds_secret_arn")
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name='us-west-2'
+    full_scan in the event lists the whole prefix instead. Files whose key and
+    ETag are already in the ledger are skipped. The watermark then moves to the
+    first new file, or to the last listed key when there is none, so files that
+    are not handled by this run are listed again.
+    """
+    client = get_s3_client()
+    paginator = client.get_paginator('list_objects_v2')
+    prefix = f"{event['domain']}/{event['dataset']}/unprocessed/"
+    operation_parameters = {'Bucket': event['source'], 'Prefix': prefix}
+    start_after = None if event.get("full_scan") else get_listing_start_after(prefix, read_watermark(store, event))
+    if start_after:
+        operation_parameters["StartAfter"] = start_after
+
+    listed_keys = []
+    new_files = []
+    for page in paginator.paginate(**operation_parameters):
+        for dataset_object in page.get("Contents", []):
+            s3_object = {
+                "key": dataset_object["Key"],
+                "etag": dataset_object["ETag"],
+                "size": dataset_object["Size"]
+            }
+            if not s3_object["key"].lower().endswith(".csv"):
+                continue
+            listed_keys.append(s3_object["key"])
+            if is_already_handled(store, event, s3_object):
+                print(f"Skipping {s3_object['key']}, already handled by a previous run")
+                continue
+            new_files.append(s3_object)
+    print(f"Found {len(new_files)} new files after {start_after}")
+    if listed_keys:
+        new_keys = [s3_object["key"] for s3_object in new_files]
+        write_watermark(store, event, min(new_keys) if new_keys else max(listed_keys))
+    return new_files
+
+def list_files(event, _):
+    """Lists the new files of the dataset for the Map state, which runs one import per file
+
+    Files are deduplicated by content here, since the Map items are imported
+    concurrently, and the skipped ones are moved right away. Only the files
+    sharing their size with another listed file can share its content, so only
+    those are hashed here and carry their content_hash, the Map worker hashes
+    the others before checking them against the imported contents. The
+    watermark stays on the first file listed for the Map, failed items are
+    retried by the state machine (TASK_RETRY) and files still unprocessed after
+    that are listed again by the next run.
+    """
+    started_at = time.monotonic()
+    store = get_metadata_store(event)
+    new_files = discover_new_files(event, store)
+    files_to_hash = get_files_sharing_size(new_files)
+    parallelism = max(1, min(int(event.get("parallelism", RAW_TO_STAGING_PARALLELISM)), len(files_to_hash) or 1))
+    unique_files, skipped_file_reports = split_duplicate_files(event, store, files_to_hash, parallelism)
+    finish_files(
+        event, store, [file_report for file_report in skipped_file_reports if file_report["status"] != "deferred"],
+        new_files
     )
+    content_hashes = dict(unique_files)
+    skipped_files = {file_report["file"] for file_report in skipped_file_reports}
+    files = [
+        {**s3_object, "content_hash": content_hashes.get(s3_object["key"])}
+        for s3_object in new_files if s3_object["key"] not in skipped_files
+    ]
+    print(json.dumps({
+        "dataset": event["dataset"],
+        "listed": len(new_files),
+        "hashed": len(files_to_hash),
+        "to_import": len(files),
+        "total_seconds": round(time.monotonic() - started_at, 3),
+        "skipped": skipped_file_reports
+    }))
+    return {"dataset": event["dataset"], "files": files}
 
-    try:
-        get_secret_value_response = client.get_secret_value(
-            SecretId=rds_secret_arn
-        )
-    except ClientError as e:
-        raise e
-    else:
-        if 'SecretString' in get_secret_value_response:
-            secret = get_secret_value_response['SecretString']
-        else:
-            secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-    
-    credentials = json.loads(secret)
+def get_files_sharing_size(s3_objects):
+    """Keys of the files whose size is also the size of another file, in listing order"""
+    files_by_size = {}
+    for s3_object in s3_objects:
+        files_by_size.setdefault(s3_object["size"], []).append(s3_object["key"])
+    return [s3_object["key"] for s3_object in s3_objects if len(files_by_size[s3_object["size"]]) > 1]
+
+def get_event_files(event, store):
+    if is_already_handled(store, event, event["file"]):
+        print(f"Skipping {event['file']['key']}, already handled by a previous run")
+        return []
+    return [event["file"]]
+
+def get_s3_import_credentials(event, force_refresh=False):
+    # Shares the warm container secret cache of database_commons, keyed by the secret ARN
+    credentials = get_secret(event.get("rds_secret_arn"), force_refresh=force_refresh)
     return credentials["aws_access_key_id"], credentials["aws_secret_access_key"]
 
 
-def move_file_to(bucket, file_path, to="processed"):
-    client = boto3.client('s3')
-    response = client.list_objects_v2(Bucket=bucket, Prefix=file_path)
-    source_key = response["Contents"][0]["Key"]
-    copy_source = {'Bucket': bucket, 'Key': source_key}
+def get_moved_file_path(file_path, to="processed"):
+    return file_path.replace("unprocessed", to)
+
+def move_files(bucket, file_reports):
+    """Moves every handled file to processed, failed or duplicate and records the outcome in its report
 
-    processed_file_path = file_path.replace("unprocessed", to)
-    print(f"moving file from {file_path} to {processed_file_path}")
-    client.copy_object(Bucket = bucket, CopySource = copy_source, Key = processed_file_path)
-    client.delete_object(Bucket = bucket, Key = source_key)
\ No newline at end of file
+    Files that could not be moved stay in unprocessed and are picked up again by the next run.
+    """
+    moves = [
+        (file_report["file"], get_moved_file_path(file_report["file"], to=file_report["status"]))
+        for file_report in file_reports
+    ]
+    move_report = move_objects(bucket, moves)
+    move_errors = {failure["key"]: failure["error"] for failure in move_report["failed"]}
+    for file_report in file_reports:
+        file_report["moved"] = file_report["file"] not in move_errors
+        if not file_report["moved"]:
+            file_report["move_error"] = move_errors[file_report["file"]]
+    return move_report
@@ -0,0 +1,77 @@
+import os
+import threading
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+# Points the pipeline at a local S3 stand-in such as MinIO or moto_server when set
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_MOVE_PARALLELISM = int(os.getenv("S3_MOVE_PARALLELISM", "8"))
+DELETE_OBJECTS_MAX_KEYS = 1000
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """One S3 client per container, clients are thread safe once created"""
+    global _s3_client
+    with _s3_client_lock:
+        if not _s3_client:
+            session = boto3.session.Session()
+            _s3_client = session.client(
+                "s3",
+                endpoint_url=S3_ENDPOINT_URL,
+                config=Config(max_pool_connections=max(10, S3_MOVE_PARALLELISM * 2))
+            )
+    return _s3_client
+
+def _copy_object(client, bucket, source_key, destination_key):
+    try:
+        client.copy_object(Bucket=bucket, CopySource={"Bucket": bucket, "Key": source_key}, Key=destination_key)
+        return None
+    except ClientError as e:
+        return str(e)
+
+def _delete_objects(client, bucket, keys):
+    """Deletes up to DELETE_OBJECTS_MAX_KEYS keys, returns the error of every key not deleted"""
+    try:
+        response = client.delete_objects(
+            Bucket=bucket,
+            Delete={"Objects": [{"Key": key} for key in keys], "Quiet": True}
+        )
+    except ClientError as e:
+        return {key: str(e) for key in keys}
+    return {error["Key"]: error.get("Message", error.get("Code")) for error in response.get("Errors", [])}
+
+def move_objects(bucket, moves, parallelism=S3_MOVE_PARALLELISM):
+    """Moves (source_key, destination_key) pairs inside the bucket
+
+    Copies run concurrently and the copied sources are then deleted with
+    delete_objects in batches of DELETE_OBJECTS_MAX_KEYS. A source is only
+    deleted once its copy succeeded, so a failed move leaves the object where
+    it was. Returns the moved source keys and the failed ones with their error.
+    """
+    client = get_s3_client()
+    moves = list(moves)
+    if not moves:
+        return {"moved": [], "failed": []}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(parallelism, len(moves)))) as executor:
+        copy_errors = list(executor.map(lambda move: _copy_object(client, bucket, *move), moves))
+
+    failed = [
+        {"key": source_key, "error": f"Not copied: {error}"}
+        for (source_key, _), error in zip(moves, copy_errors) if error
+    ]
+    copied_keys = [source_key for (source_key, _), error in zip(moves, copy_errors) if not error]
+
+    moved = []
+    for start in range(0, len(copied_keys), DELETE_OBJECTS_MAX_KEYS):
+        keys = copied_keys[start:start + DELETE_OBJECTS_MAX_KEYS]
+        delete_errors = _delete_objects(client, bucket, keys)
+        for key in keys:
+            if key in delete_errors:
+                failed.append({"key": key, "error": f"Copied but not deleted: {delete_errors[key]}"})
+            else:
+                moved.append(key)
+    return {"moved": moved, "failed": failed}
@@ -1,7 +1,238 @@
-import boto3
-
+import os
+import json
+import time
+import codecs
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from s3_commons import get_s3_client
 
+# Files dropped under hr/<dataset>/ in the source bucket land in
+# hr/<dataset>/unprocessed/ of the raw bucket. Raw keys start with the event time, so
+# they roughly sort by arrival. Retries and long copies may still write a key after
+# later ones, raw_to_staging_db lists with a lag window on that time to pick them up.
+RAW_BUCKET = os.getenv("RAW_BUCKET", "raw-globant-hr")
+# Objects above the threshold are copied server side in parts, copy_object stops at 5 GB
+MULTIPART_COPY_THRESHOLD = int(os.getenv("MULTIPART_COPY_THRESHOLD", str(64 * 1024 * 1024)))
+MULTIPART_COPY_PART_SIZE = int(os.getenv("MULTIPART_COPY_PART_SIZE", str(64 * 1024 * 1024)))
+# CSVs above RAW_SPLIT_THRESHOLD_BYTES, or above RAW_PART_MAX_BYTES when normalized, are split
+# on record boundaries into parts of about RAW_PART_MAX_BYTES, up to SOURCE_TO_RAW_PARALLELISM + 1
+# parts are held in memory while they are uploaded. Other CSVs are copied whole server side,
+# with multipart_copy above MULTIPART_COPY_THRESHOLD.
+RAW_SPLIT_THRESHOLD_BYTES = int(os.getenv("RAW_SPLIT_THRESHOLD_BYTES", str(512 * 1024 * 1024)))
+RAW_PART_MAX_BYTES = int(os.getenv("RAW_PART_MAX_BYTES", str(64 * 1024 * 1024)))
+# Re-encodes CSVs from SOURCE_ENCODING to utf-8 with \n line endings when true
+NORMALIZE_RAW_FILES = os.getenv("NORMALIZE_RAW_FILES", "false").lower() == "true"
+SOURCE_ENCODING = os.getenv("SOURCE_ENCODING", "utf-8-sig")
+SOURCE_TO_RAW_PARALLELISM = int(os.getenv("SOURCE_TO_RAW_PARALLELISM", "4"))
+READ_BUFFER_SIZE = 1024 * 1024
 
 def run(event, _):
-    pass
-    #TODO: check the s3 event and move from source bucket to the raw bucket
\ No newline at end of file
+    """Copies the objects of an S3 event batch from the source bucket to the raw bucket
+
+    Removals and keys outside <domain>/<dataset>/ are skipped. Raw keys only
+    depend on the event, so a retried batch overwrites the keys of its first try.
+    """
+    options = get_copy_options(event)
+    copies = []
+    skipped = []
+    failed = []
+    for record in event.get("Records", []):
+        source_bucket = record["s3"]["bucket"]["name"]
+        source_key = unquote_plus(record["s3"]["object"]["key"])
+        if not record.get("eventName", "").startswith("ObjectCreated"):
+            skipped.append({"source": source_key, "reason": f"Event {record.get('eventName')} is not handled"})
+            continue
+        raw_key = get_raw_key(source_key, record.get("eventTime"))
+        if not raw_key:
+            skipped.append({"source": source_key, "reason": "The key is not under <domain>/<dataset>/"})
+            continue
+        try:
+            copies.append(copy_to_raw(source_bucket, source_key, raw_key, record["s3"]["object"].get("size"), options))
+        except Exception as e:
+            print(f"File {source_key} not copied to raw")
+            print(e)
+            failed.append({"source": source_key, "error": str(e)})
+
+    report = {"copied": copies, "skipped": skipped, "failed": failed}
+    print(json.dumps(report))
+    if failed:
+        # Lets Lambda retry the batch
+        raise RuntimeError(f"{len(failed)} files not copied to raw: {', '.join(failure['source'] for failure in failed)}")
+    return report
+
+def get_copy_options(event):
+    return {
+        "raw_bucket": event.get("raw_bucket", RAW_BUCKET),
+        "normalize": event.get("normalize", NORMALIZE_RAW_FILES),
+        "source_encoding": event.get("source_encoding", SOURCE_ENCODING),
+        "split_threshold_bytes": int(event.get("split_threshold_bytes", RAW_SPLIT_THRESHOLD_BYTES)),
+        "part_max_bytes": int(event.get("part_max_bytes", RAW_PART_MAX_BYTES))
+    }
+
+def get_raw_key(source_key, event_time=None):
+    """hr/<dataset>/<name> becomes hr/<dataset>/unprocessed/<event time>-<name>, None for other keys"""
+    path_parts = source_key.split("/")
+    if len(path_parts) < 3 or not path_parts[0] or not path_parts[1] or not path_parts[-1]:
+        return None
+    domain, dataset, name = path_parts[0], path_parts[1], path_parts[-1]
+    try:
+        arrived_at = datetime.fromisoformat(event_time.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        arrived_at = datetime.now(timezone.utc)
+    arrived_at = arrived_at.astimezone(timezone.utc)
+    timestamp = arrived_at.strftime("%Y%m%dT%H%M%S") + f"{arrived_at.microsecond // 1000:03d}Z"
+    return f"{domain}/{dataset}/unprocessed/{timestamp}-{name}"
+
+def get_part_key(raw_key, part_number):
+    base, extension = os.path.splitext(raw_key)
+    return f"{base}-part-{part_number:05d}{extension}"
+
+def copy_to_raw(source_bucket, source_key, raw_key, size, options):
+    started_at = time.monotonic()
+    client = get_s3_client()
+    if size is None:
+        size = client.head_object(Bucket=source_bucket, Key=source_key)["ContentLength"]
+
+    is_csv = source_key.lower().endswith(".csv")
+    if is_csv and (options["normalize"] or size > options["split_threshold_bytes"]):
+        mode = "split" if is_split(size, options) else "normalized"
+        raw_keys = copy_csv_in_parts(source_bucket, source_key, raw_key, size, options)
+    elif size > MULTIPART_COPY_THRESHOLD:
+        mode = "multipart_copy"
+        raw_keys = [multipart_copy(source_bucket, source_key, options["raw_bucket"], raw_key, size)]
+    else:
+        mode = "copy"
+        client.copy_object(
+            Bucket=options["raw_bucket"],
+            Key=raw_key,
+            CopySource={"Bucket": source_bucket, "Key": source_key}
+        )
+        raw_keys = [raw_key]
+    seconds = time.monotonic() - started_at
+    print(f"Copied {source_key} to {len(raw_keys)} raw objects with {mode} in {seconds:.3f}s")
+    return {
+        "source": source_key,
+        "raw_keys": raw_keys,
+        "mode": mode,
+        "bytes": size,
+        "seconds": round(seconds, 3)
+    }
+
+def multipart_copy(source_bucket, source_key, bucket, key, size, part_size=MULTIPART_COPY_PART_SIZE):
+    """Server side copy with upload_part_copy, parts are copied concurrently"""
+    client = get_s3_client()
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+
+    def copy_part(part_number):
+        first_byte = (part_number - 1) * part_size
+        last_byte = min(first_byte + part_size, size) - 1
+        response = client.upload_part_copy(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            CopySource={"Bucket": source_bucket, "Key": source_key},
+            CopySourceRange=f"bytes={first_byte}-{last_byte}"
+        )
+        return {"PartNumber": part_number, "ETag": response["CopyPartResult"]["ETag"]}
+
+    part_numbers = range(1, (size + part_size - 1) // part_size + 1)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(SOURCE_TO_RAW_PARALLELISM, len(part_numbers)))) as executor:
+            parts = list(executor.map(copy_part, part_numbers))
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts})
+    except Exception as e:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise e
+    return key
+
+def _iter_normalized_chunks(stream, source_encoding):
+    """Decodes the stream incrementally into utf-8 with \\n line endings, the utf-8-sig codec drops the BOM"""
+    decoder = codecs.getincrementaldecoder(source_encoding)()
+    held_carriage_return = False
+    while True:
+        chunk = stream.read(READ_BUFFER_SIZE)
+        text = ("\r" if held_carriage_return else "") + decoder.decode(chunk, final=not chunk)
+        # A \r at the end of the chunk may be the first half of a \r\n
+        held_carriage_return = bool(chunk) and text.endswith("\r")
+        if held_carriage_return:
+            text = text[:-1]
+        yield text.replace("\r\n", "\n").replace("\r", "\n").encode("utf-8")
+        if not chunk:
+            break
+
+def iter_lines(stream, source_encoding=None):
+    """Yields the lines of the stream as bytes ending in \\n, normalized when a source encoding is given"""
+    if source_encoding:
+        chunks = _iter_normalized_chunks(stream, source_encoding)
+    else:
+        chunks = iter(lambda: stream.read(READ_BUFFER_SIZE), b"")
+    pending = b""
+    for chunk in chunks:
+        lines = (pending + chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if pending:
+        yield pending + b"\n"
+
+def iter_csv_records(lines):
+    """Joins the lines of quoted fields that contain line breaks, so parts never cut a record"""
+    record = []
+    quotes = 0
+    for line in lines:
+        record.append(line)
+        quotes += line.count(b'"')
+        if quotes % 2 == 0:
+            yield b"".join(record)
+            record = []
+            quotes = 0
+    if record:
+        yield b"".join(record)
+
+def is_split(size, options):
+    """Normalized files are streamed, so they are split whenever they do not fit in one part"""
+    return size > options["split_threshold_bytes"] or (options["normalize"] and size > options["part_max_bytes"])
+
+def copy_csv_in_parts(source_bucket, source_key, raw_key, size, options):
+    """Streams the CSV through iter_csv_records and uploads it in parts of about part_max_bytes
+
+    A file that is not split keeps raw_key. Parts are uploaded while the
+    next one is read, at most SOURCE_TO_RAW_PARALLELISM of them at a time.
+    """
+    client = get_s3_client()
+    split = is_split(size, options)
+    source_encoding = options["source_encoding"] if options["normalize"] else None
+    raw_keys = []
+    uploads = set()
+
+    def upload_part(records):
+        key = get_part_key(raw_key, len(raw_keys) + 1) if split else raw_key
+        raw_keys.append(key)
+        if len(uploads) >= SOURCE_TO_RAW_PARALLELISM:
+            done, _ = wait(uploads, return_when=FIRST_COMPLETED)
+            for upload in done:
+                uploads.remove(upload)
+                upload.result()
+        uploads.add(executor.submit(
+            client.put_object, Bucket=options["raw_bucket"], Key=key, Body=b"".join(records), ContentType="text/csv"
+        ))
+
+    response = client.get_object(Bucket=source_bucket, Key=source_key)
+    with closing(response["Body"]) as body, ThreadPoolExecutor(max_workers=SOURCE_TO_RAW_PARALLELISM) as executor:
+        records = []
+        part_bytes = 0
+        for record in iter_csv_records(iter_lines(body, source_encoding)):
+            if split and records and part_bytes + len(record) > options["part_max_bytes"]:
+                upload_part(records)
+                records = []
+                part_bytes = 0
+            records.append(record)
+            part_bytes += len(record)
+        if records or not raw_keys:
+            upload_part(records)
+        for upload in uploads:
+            upload.result()
+    return raw_keys
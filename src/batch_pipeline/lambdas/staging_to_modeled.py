@@ -1,56 +1,329 @@
+import os
+import json
+import time
+import uuid
+from psycopg2 import sql
 from database_commons import get_db_connection
 
-LOAD_DEPARTMENTS = """
-INSERT INTO departments (id,department)
+# The loads merge one range of staging ids per statement, see merge_dataset
+STAGING_CHUNK_CONDITION = """
+    ((id > %(after_id)s AND id <= %(until_id)s) OR (%(include_null_ids)s AND id IS NULL))
+"""
+
+# Every load answers with the staged, inserted and updated row counts of the chunk.
+# Rows whose values did not change are not rewritten, so reloads leave no dead tuples.
+LOAD_DEPARTMENTS = f"""
+WITH staged_departments AS (
     SELECT DISTINCT id,department FROM staging_departments 
+    WHERE {STAGING_CHUNK_CONDITION}
+),
+merged_departments AS (
+INSERT INTO departments (id,department)
+    SELECT id,department FROM staged_departments
 ON CONFLICT (id) DO 
 UPDATE 
-	SET department=EXCLUDED.department;
+	SET department=EXCLUDED.department
+	WHERE departments.department IS DISTINCT FROM EXCLUDED.department
+RETURNING (xmax = 0) AS inserted
+)
+SELECT
+    (SELECT count(*) FROM staged_departments),
+    count(*) FILTER (WHERE inserted),
+    count(*) FILTER (WHERE NOT inserted)
+FROM merged_departments;
 """
 
-LOAD_JOBS = """
-INSERT INTO jobs (id,job)
+LOAD_JOBS = f"""
+WITH staged_jobs AS (
     SELECT distinct id,job FROM staging_jobs 
+    WHERE {STAGING_CHUNK_CONDITION}
+),
+merged_jobs AS (
+INSERT INTO jobs (id,job)
+    SELECT id,job FROM staged_jobs
 ON CONFLICT (id) DO 
 UPDATE 
-	SET job=EXCLUDED.job;
+	SET job=EXCLUDED.job
+	WHERE jobs.job IS DISTINCT FROM EXCLUDED.job
+RETURNING (xmax = 0) AS inserted
+)
+SELECT
+    (SELECT count(*) FROM staged_jobs),
+    count(*) FILTER (WHERE inserted),
+    count(*) FILTER (WHERE NOT inserted)
+FROM merged_jobs;
 """
 
-LOAD_HIRED_EMPLOYEES = """
-INSERT INTO hired_employees  (name, hired_datetime, department_id, job_id)
+# Every column of hired_employees is in its conflict key, so a conflicting row is
+# always unchanged and only new employees are returned and added to the report tables
+LOAD_HIRED_EMPLOYEES = f"""
+WITH staged_employees AS (
     SELECT distinct name, hired_datetime, department_id , job_id  
     FROM staging_hired_employees 
     WHERE 
         name IS NOT NULL AND
         hired_datetime IS NOT NULL AND
-        department_id IS NOT NULL AND job_id is not NULL
-ON CONFLICT (hired_datetime, name, department_id, job_id) DO 
+        department_id IS NOT NULL AND job_id is not NULL AND
+        {STAGING_CHUNK_CONDITION}
+),
+new_employees AS (
+INSERT INTO hired_employees  (name, hired_datetime, department_id, job_id)
+    SELECT name, hired_datetime, department_id, job_id FROM staged_employees
+ON CONFLICT (hired_datetime, name, department_id, job_id) DO NOTHING
+RETURNING hired_datetime, department_id, job_id
+),
+quarter_report AS (
+INSERT INTO report_hires_by_department_job_quarter (department_id, job_id, year, quarter, hired)
+    SELECT
+        department_id,
+        job_id,
+        extract(year from hired_datetime)::integer,
+        extract(quarter from hired_datetime)::integer,
+        count(*)
+    FROM new_employees
+    GROUP BY 1, 2, 3, 4
+ON CONFLICT (department_id, job_id, year, quarter) DO
+UPDATE
+	SET hired = report_hires_by_department_job_quarter.hired + EXCLUDED.hired
+),
+year_report AS (
+INSERT INTO report_hires_by_department_year (department_id, year, hired)
+    SELECT
+        department_id,
+        extract(year from hired_datetime)::integer,
+        count(*)
+    FROM new_employees
+    GROUP BY 1, 2
+ON CONFLICT (department_id, year) DO
+UPDATE
+	SET hired = report_hires_by_department_year.hired + EXCLUDED.hired
+),
+department_totals AS (
+INSERT INTO report_total_hires_by_department (department_id, hired)
+    SELECT department_id, count(*)
+    FROM new_employees
+    GROUP BY 1
+ON CONFLICT (department_id) DO
+UPDATE
+	SET hired = report_total_hires_by_department.hired + EXCLUDED.hired
+),
+department_job_totals AS (
+INSERT INTO report_total_hires_by_department_job (department_id, job_id, hired)
+    SELECT department_id, job_id, count(*)
+    FROM new_employees
+    GROUP BY 1, 2
+ON CONFLICT (department_id, job_id) DO
 UPDATE
-	SET 
-	name=EXCLUDED.name,
-	hired_datetime = EXCLUDED.hired_datetime,
-	department_id=EXCLUDED.department_id,
-	job_id=EXCLUDED.job_id;
+	SET hired = report_total_hires_by_department_job.hired + EXCLUDED.hired
+)
+SELECT
+    (SELECT count(*) FROM staged_employees),
+    (SELECT count(*) FROM new_employees),
+    0;
 """
+# Invalidates the responses cached by the reports API, see sql/002_data_versions.sql
+BUMP_DATA_VERSION = """
+UPDATE data_versions
+    SET version = version + 1, updated_at = now()
+WHERE name = 'hired_employees';
+"""
+
+# Checkpoints of the chunked merge, see sql/004_staging_merge_checkpoints.sql
+READ_CHECKPOINT = """
+SELECT last_id, staging_rows FROM staging_merge_checkpoints WHERE dataset = %s;
+"""
+
+SAVE_CHECKPOINT = """
+INSERT INTO staging_merge_checkpoints (dataset, last_id, staging_rows, updated_at)
+    VALUES (%s, %s, %s, now())
+ON CONFLICT (dataset) DO
+UPDATE
+	SET last_id = EXCLUDED.last_id, staging_rows = EXCLUDED.staging_rows, updated_at = EXCLUDED.updated_at;
+"""
+
 CLEAN_STAGING = """
-DELETE FROM staging_departments;
-DELETE FROM staging_jobs;
-DELETE FROM staging_hired_employees;
+TRUNCATE staging_departments, staging_jobs, staging_hired_employees;
+DELETE FROM staging_merge_checkpoints;
+"""
+
+# Run ledger, see sql/005_staging_to_modeled_runs.sql
+START_RUN = """
+INSERT INTO staging_to_modeled_runs (run_id, status) VALUES (%s, 'running')
+ON CONFLICT (run_id) DO
+UPDATE
+	SET status = 'running', started_at = now(), finished_at = NULL, error = NULL;
+"""
+
+RECORD_STATEMENT = """
+INSERT INTO staging_to_modeled_run_statements
+    (run_id, statement, dataset, after_id, until_id, rows, inserted, updated, seconds)
+    VALUES (%(run_id)s, %(statement)s, %(dataset)s, %(after_id)s, %(until_id)s, %(rows)s, %(inserted)s, %(updated)s, %(seconds)s);
+"""
+
+FINISH_RUN = """
+UPDATE staging_to_modeled_runs
+    SET status = %(status)s, finished_at = now(), rows = %(rows)s, inserted = %(inserted)s,
+        updated = %(updated)s, unchanged = %(unchanged)s, error = %(error)s
+WHERE run_id = %(run_id)s;
 """
 
+# Dimensions first, hired_employees references them
+MERGE_STATEMENTS = [
+    ("departments", LOAD_DEPARTMENTS),
+    ("jobs", LOAD_JOBS),
+    ("hired_employees", LOAD_HIRED_EMPLOYEES)
+]
+# Width of the staging id range merged and committed at a time
+STAGING_MERGE_CHUNK_SIZE = int(os.getenv("STAGING_MERGE_CHUNK_SIZE", "50000"))
+
 
 def run(event, _):
+    """Merges staging into the modeled tables and records the run in the run ledger
+
+    Errors are recorded in the ledger and raised, so the state machine retries
+    this stage, which resumes from the checkpoints of the failed run.
+    """
+    run_id = event.get("run_id") or str(uuid.uuid4())
     connection = get_db_connection(event)
     try:
         with connection:
             with connection.cursor() as cur:
-                cur.execute(LOAD_DEPARTMENTS)
-                cur.execute(LOAD_JOBS)
-                cur.execute(LOAD_HIRED_EMPLOYEES)
+                cur.execute(START_RUN, (run_id,))
+        chunk_size = int(event.get("chunk_size", STAGING_MERGE_CHUNK_SIZE))
+        chunk_reports = []
+        for dataset, load_statement in MERGE_STATEMENTS:
+            chunk_reports += merge_dataset(connection, run_id, dataset, load_statement, chunk_size)
+        totals = {
+            metric: sum(chunk_report[metric] for chunk_report in chunk_reports)
+            for metric in ("rows", "inserted", "updated", "unchanged")
+        }
+        with connection:
+            with connection.cursor() as cur:
+                started_at = time.monotonic()
                 cur.execute(CLEAN_STAGING)
+                record_statement(cur, run_id, "clean_staging", time.monotonic() - started_at)
+                cur.execute(FINISH_RUN, {"run_id": run_id, "status": "succeeded", "error": None, **totals})
+        report = {"run_id": run_id, "datasets": summarize_chunks(chunk_reports), "chunks": chunk_reports}
+        print(json.dumps(report["datasets"]))
+        return report
     except Exception as e:
-        connection.rollback()
-    else:
-        connection.commit()
+        print(f"Run {run_id} failed: {e}")
+        try:
+            connection.rollback()
+        except Exception as rollback_error:
+            # The failure may have closed the connection, which must not hide the error of the run
+            print(f"Run {run_id} not rolled back: {rollback_error}")
+        record_failed_run(connection, run_id, e)
+        raise e
     finally:
         connection.close()
+
+def record_statement(cursor, run_id, statement, seconds, **metrics):
+    cursor.execute(RECORD_STATEMENT, {
+        "run_id": run_id,
+        "statement": statement,
+        "dataset": metrics.get("dataset"),
+        "after_id": metrics.get("after_id"),
+        "until_id": metrics.get("until_id"),
+        "rows": metrics.get("rows"),
+        "inserted": metrics.get("inserted"),
+        "updated": metrics.get("updated"),
+        "seconds": round(seconds, 6)
+    })
+
+def record_failed_run(connection, run_id, error):
+    try:
+        with connection:
+            with connection.cursor() as cur:
+                cur.execute(FINISH_RUN, {
+                    "run_id": run_id,
+                    "status": "failed",
+                    "rows": None,
+                    "inserted": None,
+                    "updated": None,
+                    "unchanged": None,
+                    "error": str(error)
+                })
+    except Exception as e:
+        # A broken connection must not hide the error of the run
+        print(f"Run {run_id} not recorded as failed: {e}")
+
+def get_staging_bounds(cursor, dataset):
+    cursor.execute(sql.SQL("SELECT count(*), min(id), max(id) FROM {}").format(
+        sql.Identifier(f"staging_{dataset}")
+    ))
+    return cursor.fetchone()
+
+def merge_dataset(connection, run_id, dataset, load_statement, chunk_size):
+    """Merges the staging table in id ranges of chunk_size, committing each range with its checkpoint
+
+    A run that failed half way resumes after the last committed range, as long
+    as the staging table was not loaded again in between.
+    """
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be at least 1, got {chunk_size}")
+    with connection:
+        with connection.cursor() as cur:
+            staging_rows, min_id, max_id = get_staging_bounds(cur, dataset)
+            cur.execute(READ_CHECKPOINT, (dataset,))
+            checkpoint = cur.fetchone()
+    if not staging_rows:
+        return []
+    if checkpoint and checkpoint[1] == staging_rows:
+        after_id = checkpoint[0]
+        print(f"Resuming the {dataset} merge after id {after_id}")
+    else:
+        after_id = min_id - 1 if min_id is not None else 0
+    max_id = max_id if max_id is not None else after_id
+
+    chunk_reports = []
+    while True:
+        until_id = min(after_id + chunk_size, max_id)
+        is_last_chunk = until_id >= max_id
+        started_at = time.monotonic()
+        with connection:
+            with connection.cursor() as cur:
+                cur.execute(load_statement, {
+                    "after_id": after_id,
+                    "until_id": until_id,
+                    "include_null_ids": is_last_chunk
+                })
+                rows, inserted, updated = cur.fetchone()
+                load_seconds = time.monotonic() - started_at
+                record_statement(
+                    cur, run_id, f"load_{dataset}", load_seconds, dataset=dataset, after_id=after_id,
+                    until_id=until_id, rows=rows, inserted=inserted, updated=updated
+                )
+                # No-op reloads keep the responses cached by the reports API valid
+                if inserted or updated:
+                    cur.execute(BUMP_DATA_VERSION)
+                cur.execute(SAVE_CHECKPOINT, (dataset, until_id, staging_rows))
+        seconds = time.monotonic() - started_at
+        chunk_report = {
+            "dataset": dataset,
+            "after_id": after_id,
+            "until_id": until_id,
+            "rows": rows,
+            "inserted": inserted,
+            "updated": updated,
+            "unchanged": rows - inserted - updated,
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(rows / seconds) if seconds else None
+        }
+        print(json.dumps(chunk_report))
+        chunk_reports.append(chunk_report)
+        if is_last_chunk:
+            return chunk_reports
+        after_id = until_id
+
+def summarize_chunks(chunk_reports):
+    summary = {}
+    for chunk_report in chunk_reports:
+        dataset_summary = summary.setdefault(
+            chunk_report["dataset"], {"rows": 0, "inserted": 0, "updated": 0, "unchanged": 0, "seconds": 0.0}
+        )
+        for metric in dataset_summary:
+            dataset_summary[metric] += chunk_report[metric]
+    for dataset_summary in summary.values():
+        dataset_summary["seconds"] = round(dataset_summary["seconds"], 3)
+    return summary
@@ -1,11 +1,89 @@
+import io
+import os
+import re
+import csv
+import gzip
 import json
-def form_response(body, code = 200):
+import base64
+from itertools import chain, islice
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies below this size are not worth the compression and base64 overhead
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+NDJSON_CONTENT_TYPES = ("application/x-ndjson", "application/jsonl", "application/json-seq")
+# Postgres types whose Python values the json module cannot encode
+NUMERIC_TYPE_OID = 1700
+TEMPORAL_TYPE_OIDS = (1082, 1083, 1114, 1184, 1266)
+ENCODE_BATCH_SIZE = 1000
+JSON_LAYOUTS = ("rows", "columns")
+RESPONSE_CONTENT_TYPES = {
+    "json": "application/json",
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv"
+}
+_json_decoder = json.JSONDecoder()
+_whitespace = re.compile(r"\s*")
+
+def form_response(body, code = 200, headers = None, encoded = False, accept_encoding = None):
     
     response = {
         "isBase64Encoded": False,
         "statusCode": code, 
-        "body": json.dumps(body)
+        "body": body if encoded else json.dumps(body)
     }
+    if headers:
+        response["headers"] = dict(headers)
+    if accept_encoding is not None:
+        compress_response(response, accept_encoding)
+    return response
+
+def _parse_accept_encoding(accept_encoding):
+    accepted_encodings = {}
+    for item in accept_encoding.split(","):
+        encoding, _, parameters = item.strip().partition(";")
+        quality = 1.0
+        parameter, _, value = parameters.strip().partition("=")
+        if parameter.strip() == "q":
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        if encoding:
+            accepted_encodings[encoding.strip().lower()] = quality
+    return accepted_encodings
+
+def choose_content_encoding(accept_encoding):
+    """Returns br or gzip, whichever the client prefers, or None when it accepts neither"""
+    accepted_encodings = _parse_accept_encoding(accept_encoding or "")
+    supported_encodings = ["br", "gzip"] if brotli else ["gzip"]
+    candidates = [
+        (accepted_encodings.get(encoding, accepted_encodings.get("*", 0.0)), encoding)
+        for encoding in supported_encodings
+    ]
+    # Ties go to the first supported encoding, the better compressor
+    quality, encoding = max(candidates, key=lambda candidate: candidate[0])
+    return encoding if quality > 0 else None
+
+def compress_response(response, accept_encoding):
+    """Compresses the body in place when it is big enough and the client accepts br or gzip"""
+    headers = response.setdefault("headers", {})
+    headers["Vary"] = "Accept-Encoding"
+    body = response["body"].encode("utf-8")
+    encoding = choose_content_encoding(accept_encoding)
+    if not encoding or len(body) < COMPRESSION_MIN_BYTES:
+        return response
+
+    if encoding == "br":
+        compressed_body = brotli.compress(body, quality=5)
+    else:
+        compressed_body = gzip.compress(body, compresslevel=6)
+    response["body"] = base64.b64encode(compressed_body).decode("ascii")
+    response["isBase64Encoded"] = True
+    headers["Content-Encoding"] = encoding
     return response
 
 def handle_exception(exception: Exception, code = 500):
@@ -18,3 +96,162 @@ def handle_exception(exception: Exception, code = 500):
         "error": message
     }
     return form_response(body, code)
+
+def get_header(event, name):
+    headers = event.get("headers") or {}
+    for header, value in headers.items():
+        if header.lower() == name.lower():
+            return value
+    return None
+
+def get_query_parameter(event, name, default=None):
+    parameters = event.get("queryStringParameters") or {}
+    return parameters.get(name, default)
+
+def _iter_json_array(text):
+    position = _whitespace.match(text).end()
+    assert text[position:position + 1] == "[", "The body must be a JSON array or NDJSON"
+    position = _whitespace.match(text, position + 1).end()
+    if text[position:position + 1] == "]":
+        position += 1
+    else:
+        while True:
+            record, position = _json_decoder.raw_decode(text, position)
+            yield record
+            position = _whitespace.match(text, position).end()
+            separator = text[position:position + 1]
+            position = _whitespace.match(text, position + 1).end()
+            if separator == "]":
+                break
+            assert separator == ",", f"Malformed JSON array at character {position}"
+    assert not text[position:].strip(), f"Unexpected content after the JSON array at character {position}"
+
+def _iter_ndjson(text):
+    for line in io.StringIO(text):
+        if line.strip():
+            yield json.loads(line)
+
+def iter_request_records(event):
+    """Yields the records of a JSON array or NDJSON request body one at a time
+
+    Records are decoded lazily, so only the ones being processed are held as
+    Python objects next to the raw body.
+    """
+    body = event["body"]
+    if isinstance(body, list):
+        yield from body
+        return
+    assert isinstance(body, str), "The body must be a JSON array or NDJSON"
+
+    if event.get("isBase64Encoded"):
+        body = base64.b64decode(body).decode("utf-8")
+    content_type = (get_header(event, "Content-Type") or "").split(";")[0].strip().lower()
+    if content_type in NDJSON_CONTENT_TYPES:
+        yield from _iter_ndjson(body)
+    else:
+        yield from _iter_json_array(body)
+
+def iter_chunks(records, chunk_size):
+    """Groups an iterable in lists of chunk_size, yielding the index of the first record with each chunk"""
+    records = iter(records)
+    first_index = 0
+    chunk = list(islice(records, chunk_size))
+    while chunk:
+        yield first_index, chunk
+        first_index += len(chunk)
+        chunk = list(islice(records, chunk_size))
+
+def _get_column_names(cursor):
+    return [column[0] for column in cursor.description or []]
+
+def _decimal_to_json(value):
+    if value is None:
+        return None
+    return int(value) if value == value.to_integral_value() else float(value)
+
+def _temporal_to_json(value):
+    return None if value is None else value.isoformat()
+
+def _get_column_converters(cursor):
+    """Picks once per column how to make its values JSON serializable, None when they already are"""
+    converters = []
+    for column in cursor.description or []:
+        if column[1] == NUMERIC_TYPE_OID:
+            converters.append(_decimal_to_json)
+        elif column[1] in TEMPORAL_TYPE_OIDS:
+            converters.append(_temporal_to_json)
+        else:
+            converters.append(None)
+    return converters
+
+def _convert_rows(rows, converters):
+    positions = [(position, converter) for position, converter in enumerate(converters) if converter]
+    if not positions:
+        return rows
+    converted_rows = []
+    for row in rows:
+        row = list(row)
+        for position, converter in positions:
+            row[position] = converter(row[position])
+        converted_rows.append(row)
+    return converted_rows
+
+def _get_batch_writer(output, cursor, response_format, layout):
+    """Returns the opening text, a function writing a batch of rows and the closing text"""
+    columns = _get_column_names(cursor)
+    converters = _get_column_converters(cursor)
+
+    if response_format == "csv":
+        csv_writer = csv.writer(output, lineterminator="\n")
+        def write_csv_batch(rows, first_index):
+            csv_writer.writerows(rows)
+        csv_writer.writerow(columns)
+        return "", write_csv_batch, ""
+
+    if response_format == "ndjson":
+        def write_ndjson_batch(rows, first_index):
+            for row in _convert_rows(rows, converters):
+                output.write(json.dumps(dict(zip(columns, row))))
+                output.write("\n")
+        return "", write_ndjson_batch, ""
+
+    # Whole batches go through the C encoder at once, without the surrounding brackets
+    def write_json_batch(rows, first_index):
+        rows = _convert_rows(rows, converters)
+        if layout == "rows":
+            rows = [dict(zip(columns, row)) for row in rows]
+        if first_index:
+            output.write(",")
+        output.write(json.dumps(rows)[1:-1])
+    if layout == "columns":
+        return f'{{"columns": {json.dumps(columns)}, "data": [', write_json_batch, "]}"
+    return "[", write_json_batch, "]"
+
+def encode_cursor_rows(cursor, response_format="json", limit=None, layout="rows"):
+    """Serializes the tuples of a cursor as json, ndjson or csv
+
+    Rows are encoded in batches of ENCODE_BATCH_SIZE as they are fetched instead
+    of being materialized as dictionaries first. json supports the rows layout,
+    a list of objects, and the columns layout, {"columns": [...], "data": [[...]]}.
+    Returns the encoded body, the last row written and whether the cursor had
+    more rows than limit.
+    """
+    output = io.StringIO()
+    # One extra row is read to know if there is a next page
+    rows = islice(cursor, None if limit is None else limit + 1)
+    batches = iter_chunks(rows, ENCODE_BATCH_SIZE)
+    first_batch = next(batches, None)
+    opening, write_batch, closing = _get_batch_writer(output, cursor, response_format, layout)
+
+    output.write(opening)
+    last_row = None
+    has_more = False
+    for first_index, batch in chain([first_batch] if first_batch else [], batches):
+        if limit is not None and first_index + len(batch) > limit:
+            batch = batch[:limit - first_index]
+            has_more = True
+        if batch:
+            write_batch(batch, first_index)
+            last_row = batch[-1]
+    output.write(closing)
+    return output.getvalue(), last_row, has_more
@@ -1,28 +1,50 @@
 import json
+import time
 import boto3
 import base64
 import psycopg2
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 from botocore.exceptions import ClientError
-from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
 import os
+import uuid
 
-def _get_database_secret(event=None):
-    
-    if not event:
-        target_db_secret_arn = os.getenv("TARGET_DB_SECRET")
-    else:
-        target_db_secret_arn = event.get("target_db_secret", None)
-    
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name='us-west-2'
-    )
+# Secrets are cached per warm container, keyed by the secret ARN
+SECRET_CACHE_TTL_SECONDS = int(os.getenv("SECRET_CACHE_TTL_SECONDS", "300"))
+secret_cache_stats = {"hits": 0, "misses": 0}
+_secrets_cache = {}
+_secrets_client = None
+
+# Connections are lent by a pool kept per warm container, so they are reused across
+# invocations and handlers that fan out database work on threads get one each
+DB_POOL_MIN_CONNECTIONS = int(os.getenv("DB_POOL_MIN_CONNECTIONS", "1"))
+DB_POOL_MAX_CONNECTIONS = int(os.getenv("DB_POOL_MAX_CONNECTIONS", "4"))
+DB_POOL_CHECKOUT_TIMEOUT_SECONDS = float(os.getenv("DB_POOL_CHECKOUT_TIMEOUT_SECONDS", "10"))
+DB_POOL_MAX_CONNECTION_AGE_SECONDS = float(os.getenv("DB_POOL_MAX_CONNECTION_AGE_SECONDS", "900"))
+_connection_pool = None
+_connection_pool_lock = threading.Lock()
 
+# Rows fetched per round trip by server side cursors
+SERVER_CURSOR_ITERSIZE = int(os.getenv("SERVER_CURSOR_ITERSIZE", "2000"))
+
+def _get_secrets_client():
+    global _secrets_client
+    if not _secrets_client:
+        session = boto3.session.Session()
+        _secrets_client = session.client(
+            service_name='secretsmanager',
+            region_name='us-west-2'
+        )
+    return _secrets_client
+
+def _fetch_secret(secret_arn):
+    client = _get_secrets_client()
     try:
         get_secret_value_response = client.get_secret_value(
-            SecretId=target_db_secret_arn
+            SecretId=secret_arn
         )
     except ClientError as e:
         raise e
@@ -31,35 +53,269 @@ def _get_database_secret(event=None):
             secret = get_secret_value_response['SecretString']
         else:
             secret = base64.b64decode(get_secret_value_response['SecretBinary'])
-    
-    database_secret = json.loads(secret)
-    return database_secret
 
-def get_db_connection(event=None):
-    database_secret = _get_database_secret(event)
-    connection = psycopg2.connect(
+    return json.loads(secret)
+
+def get_secret(secret_arn, force_refresh=False):
+    cached_secret = _secrets_cache.get(secret_arn)
+    is_fresh = cached_secret and time.monotonic() - cached_secret["fetched_at"] < SECRET_CACHE_TTL_SECONDS
+    if is_fresh and not force_refresh:
+        secret_cache_stats["hits"] += 1
+        return cached_secret["secret"]
+
+    secret_cache_stats["misses"] += 1
+    secret = _fetch_secret(secret_arn)
+    _secrets_cache[secret_arn] = {"secret": secret, "fetched_at": time.monotonic()}
+    return secret
+
+def _get_database_secret(event=None, force_refresh=False):
+
+    if not event:
+        target_db_secret_arn = os.getenv("TARGET_DB_SECRET")
+    else:
+        target_db_secret_arn = event.get("target_db_secret", None)
+
+    return get_secret(target_db_secret_arn, force_refresh=force_refresh)
+
+def _is_authentication_error(error):
+    return "authentication failed" in str(error)
+
+def _connect(database_secret):
+    return psycopg2.connect(
         database=database_secret['dbname'],
         user=database_secret['username'],
         password=database_secret['password'],
         host=database_secret['host'],
         port=database_secret['port']
     )
+
+def get_db_connection(event=None):
+    database_secret = _get_database_secret(event)
+    try:
+        connection = _connect(database_secret)
+    except psycopg2.OperationalError as e:
+        if not _is_authentication_error(e):
+            raise e
+        # The cached secret may be stale after a rotation, fetch it again and retry once
+        print("Database authentication failed, refreshing the cached secret")
+        database_secret = _get_database_secret(event, force_refresh=True)
+        connection = _connect(database_secret)
     return connection
 
-def get_json_results_from_db(sql, parameters = None, connection = None):
-    if not connection:
-        connection = get_db_connection()
-    result = []
+def _is_connection_alive(connection):
+    if connection.closed:
+        return False
     try:
-        with connection:
-            with connection.cursor(cursor_factory=RealDictCursor) as cur:
-                if parameters:
-                    cur.execute(sql, parameters)
-                else:
-                    cur.execute(sql)
-                result = cur.fetchall()
-        return result
-    except Exception as e:
-        raise e
-    finally:
-        connection.close()
+        # Discard any transaction left open by a previous invocation before checking
+        connection.rollback()
+        with connection.cursor() as cur:
+            cur.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error as e:
+        print(f"Persistent connection failed the liveness check: {e}")
+        return False
+
+@contextmanager
+def borrow_db_connection():
+    """Lends a pooled connection inside a transaction, the connection goes back to the pool afterwards"""
+    with get_connection_pool().connection() as connection:
+        yield connection
+
+def log_pool_metrics():
+    if _connection_pool:
+        print(json.dumps({"db_pool": _connection_pool.get_metrics()}))
+
+@contextmanager
+def open_server_side_cursor(sql, parameters=None, itersize=SERVER_CURSOR_ITERSIZE):
+    """Executes the query on a named cursor, iterating it fetches itersize tuples per round trip
+
+    The cursor description is only filled after the first fetch.
+    """
+    with borrow_db_connection() as connection:
+        with connection.cursor(name=f"stream_{uuid.uuid4().hex}") as cur:
+            cur.itersize = itersize
+            cur.execute(sql, parameters)
+            yield cur
+
+# Bumped in the same transaction as every hired_employees write, see sql/002_data_versions.sql
+HIRED_EMPLOYEES_DATA = "hired_employees"
+
+def get_data_version(name=HIRED_EMPLOYEES_DATA):
+    """Returns the (version, updated_at) pair of the data set"""
+    with borrow_db_connection() as connection:
+        with connection.cursor() as cur:
+            cur.execute("select version, updated_at from data_versions where name = %s", (name,))
+            row = cur.fetchone()
+    if not row:
+        # A server misconfiguration, not a bad request
+        raise RuntimeError(f"Missing data version {name}, apply sql/002_data_versions.sql")
+    return row
+
+def bump_data_version(cursor, name=HIRED_EMPLOYEES_DATA):
+    cursor.execute(
+        "update data_versions set version = version + 1, updated_at = now() where name = %s",
+        (name,)
+    )
+
+class _SecretConnectionPool(ThreadedConnectionPool):
+    """ThreadedConnectionPool opening its connections with a function instead of fixed parameters
+
+    Idle connections are kept up to maxconn, the base class closes every returned
+    connection above minconn. on_close is called with every connection it closes.
+    """
+
+    def __init__(self, min_connections, max_connections, connect, on_close):
+        self._open_connection = connect
+        self._on_close = on_close
+        super().__init__(min_connections, max_connections)
+
+    def _connect(self, key=None):
+        connection = self._open_connection()
+        if key is not None:
+            self._used[key] = connection
+            self._rused[id(connection)] = key
+        else:
+            self._pool.append(connection)
+        return connection
+
+    def _putconn(self, conn, key=None, close=False):
+        if self.closed:
+            raise PoolError("connection pool is closed")
+        if key is None:
+            key = self._rused.get(id(conn))
+            if key is None:
+                raise PoolError("trying to put unkeyed connection")
+
+        keep = not close and not conn.closed and len(self._pool) < self.maxconn
+        if keep and conn.info.transaction_status == TRANSACTION_STATUS_UNKNOWN:
+            # The server connection was lost
+            keep = False
+        elif keep and conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+        if keep:
+            self._pool.append(conn)
+        else:
+            conn.close()
+            self._on_close(conn)
+
+        if not self.closed or key in self._used:
+            del self._used[key]
+            del self._rused[id(conn)]
+
+class PooledConnectionProvider:
+    """Thread safe connection provider on top of ThreadedConnectionPool
+
+    Checkouts wait up to checkout_timeout seconds for a free connection, every
+    connection is health checked when lent and recycled once it is older than
+    max_connection_age seconds. Connections are opened with get_db_connection,
+    so a rotated secret is fetched again when the authentication fails.
+    """
+
+    def __init__(self, min_connections, max_connections, checkout_timeout, max_connection_age, event=None):
+        self.event = event
+        self.max_connections = max_connections
+        self.checkout_timeout = checkout_timeout
+        self.max_connection_age = max_connection_age
+        self._created_at = {}
+        self._pool = _SecretConnectionPool(min_connections, max_connections, self._connect, self._forget)
+        self._available_slots = threading.BoundedSemaphore(max_connections)
+        self._metrics_lock = threading.Lock()
+        self._metrics = {
+            "checkouts": 0,
+            "checkout_timeouts": 0,
+            "recycled_connections": 0,
+            "in_use": 0,
+            "peak_in_use": 0,
+            "total_wait_seconds": 0.0,
+            "max_wait_seconds": 0.0
+        }
+
+    def _connect(self):
+        connection = get_db_connection(self.event)
+        self._created_at[id(connection)] = time.monotonic()
+        return connection
+
+    def _is_expired(self, connection):
+        return time.monotonic() - self._created_at.get(id(connection), 0) > self.max_connection_age
+
+    def _forget(self, connection):
+        self._created_at.pop(id(connection), None)
+        with self._metrics_lock:
+            self._metrics["recycled_connections"] += 1
+
+    def _discard(self, connection):
+        self._pool.putconn(connection, close=True)
+
+    def _checkout(self):
+        wait_started_at = time.monotonic()
+        if not self._available_slots.acquire(timeout=self.checkout_timeout):
+            with self._metrics_lock:
+                self._metrics["checkout_timeouts"] += 1
+            raise PoolError(f"No database connection available after {self.checkout_timeout} seconds")
+
+        try:
+            connection = self._pool.getconn()
+            while self._is_expired(connection) or not _is_connection_alive(connection):
+                self._discard(connection)
+                connection = self._pool.getconn()
+        except Exception as e:
+            self._available_slots.release()
+            raise e
+
+        wait_seconds = time.monotonic() - wait_started_at
+        with self._metrics_lock:
+            self._metrics["checkouts"] += 1
+            self._metrics["in_use"] += 1
+            self._metrics["peak_in_use"] = max(self._metrics["peak_in_use"], self._metrics["in_use"])
+            self._metrics["total_wait_seconds"] += wait_seconds
+            self._metrics["max_wait_seconds"] = max(self._metrics["max_wait_seconds"], wait_seconds)
+        return connection
+
+    def _release(self, connection):
+        try:
+            if connection.closed:
+                self._discard(connection)
+            else:
+                self._pool.putconn(connection)
+        finally:
+            with self._metrics_lock:
+                self._metrics["in_use"] -= 1
+            self._available_slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Lends a pooled connection inside a transaction and gives it back to the pool afterwards"""
+        connection = self._checkout()
+        try:
+            with connection:
+                yield connection
+        finally:
+            self._release(connection)
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            metrics = dict(self._metrics)
+        metrics["utilisation"] = metrics["in_use"] / self.max_connections
+        metrics["average_wait_seconds"] = metrics["total_wait_seconds"] / metrics["checkouts"] if metrics["checkouts"] else 0.0
+        return metrics
+
+    def close(self):
+        self._pool.closeall()
+        self._created_at.clear()
+
+def get_connection_pool(event=None):
+    global _connection_pool
+    with _connection_pool_lock:
+        if not _connection_pool:
+            _connection_pool = PooledConnectionProvider(
+                min_connections=DB_POOL_MIN_CONNECTIONS,
+                max_connections=DB_POOL_MAX_CONNECTIONS,
+                checkout_timeout=DB_POOL_CHECKOUT_TIMEOUT_SECONDS,
+                max_connection_age=DB_POOL_MAX_CONNECTION_AGE_SECONDS,
+                event=event
+            )
+    return _connection_pool
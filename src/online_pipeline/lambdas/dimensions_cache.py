@@ -0,0 +1,80 @@
+import os
+import time
+from database_commons import borrow_db_connection
+
+# Department and job ids are cached per warm container and reloaded on a TTL or when a name is missing
+DIMENSIONS_CACHE_TTL_SECONDS = int(os.getenv("DIMENSIONS_CACHE_TTL_SECONDS", "300"))
+# Stops payloads full of unknown names from reloading the cache on every request
+DIMENSIONS_MIN_REFRESH_SECONDS = int(os.getenv("DIMENSIONS_MIN_REFRESH_SECONDS", "5"))
+_dimensions = {"version": 0, "loaded_at": None, "departments": {}, "jobs": {}}
+
+def _read_dimensions(connection):
+    with connection.cursor() as cur:
+        cur.execute("select department, id from departments")
+        departments = dict(cur.fetchall())
+        cur.execute("select job, id from jobs")
+        jobs = dict(cur.fetchall())
+    return departments, jobs
+
+def _load_dimensions(connection=None):
+    global _dimensions
+    # Callers already inside a transaction pass their connection so it is not committed under them
+    if connection:
+        departments, jobs = _read_dimensions(connection)
+    else:
+        with borrow_db_connection() as borrowed_connection:
+            departments, jobs = _read_dimensions(borrowed_connection)
+    # Swapped in one assignment so readers never see a half loaded version
+    _dimensions = {
+        "version": _dimensions["version"] + 1,
+        "loaded_at": time.monotonic(),
+        "departments": departments,
+        "jobs": jobs
+    }
+    print(f"Loaded dimensions version {_dimensions['version']}: {len(departments)} departments, {len(jobs)} jobs")
+    return _dimensions
+
+def get_dimensions(force_refresh=False, connection=None):
+    loaded_at = _dimensions["loaded_at"]
+    is_expired = loaded_at is None or time.monotonic() - loaded_at >= DIMENSIONS_CACHE_TTL_SECONDS
+    if force_refresh or is_expired:
+        return _load_dimensions(connection)
+    return _dimensions
+
+def _has_unknown_names(employees, dimensions):
+    return any(
+        employee["department"] not in dimensions["departments"] or employee["job"] not in dimensions["jobs"]
+        for employee in employees
+    )
+
+def resolve_dimension_ids(employees, indexes=None, connection=None):
+    """Maps department and job names to their ids
+
+    Returns the resolved rows and a list of errors with the index of every row
+    whose department or job is unknown, indexes default to the row positions.
+    The cache is reloaded once when a name is missing, in case it was created
+    after the last load.
+    """
+    dimensions = get_dimensions(connection=connection)
+    is_refreshable = time.monotonic() - dimensions["loaded_at"] >= DIMENSIONS_MIN_REFRESH_SECONDS
+    if is_refreshable and _has_unknown_names(employees, dimensions):
+        dimensions = get_dimensions(force_refresh=True, connection=connection)
+
+    resolved_employees = []
+    errors = []
+    indexes = indexes if indexes is not None else range(len(employees))
+    for index, employee in zip(indexes, employees):
+        department_id = dimensions["departments"].get(employee["department"])
+        job_id = dimensions["jobs"].get(employee["job"])
+        if department_id is None:
+            errors.append({"index": index, "reason": f"Unknown department: {employee['department']}"})
+        elif job_id is None:
+            errors.append({"index": index, "reason": f"Unknown job: {employee['job']}"})
+        else:
+            resolved_employees.append({
+                "index": index,
+                "name": employee["name"],
+                "department_id": department_id,
+                "job_id": job_id
+            })
+    return resolved_employees, errors
@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Encoded report bodies are cached per warm container and, when REPORTS_CACHE_DIR
+# is set, in files shared by every container that mounts that directory
+REPORTS_CACHE_MAX_ENTRIES = int(os.getenv("REPORTS_CACHE_MAX_ENTRIES", "256"))
+REPORTS_CACHE_DIR = os.getenv("REPORTS_CACHE_DIR")
+report_cache_stats = {"memory_hits": 0, "file_hits": 0, "misses": 0}
+_memory_cache = OrderedDict()
+_memory_cache_lock = threading.Lock()
+
+def build_cache_key(resource, parameters=None):
+    parameters = parameters or {}
+    serialized_parameters = json.dumps(parameters, sort_keys=True, default=str)
+    return hashlib.sha1(f"{resource}?{serialized_parameters}".encode("utf-8")).hexdigest()
+
+def _get_cache_file_path(cache_key):
+    return os.path.join(REPORTS_CACHE_DIR, f"{cache_key}.json")
+
+def _get_from_file(cache_key, data_version):
+    try:
+        with open(_get_cache_file_path(cache_key)) as cache_file:
+            entry = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    return entry["body"] if entry.get("version") == data_version else None
+
+def _put_in_file(cache_key, data_version, body):
+    os.makedirs(REPORTS_CACHE_DIR, exist_ok=True)
+    cache_file_path = _get_cache_file_path(cache_key)
+    temporary_file_path = f"{cache_file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_file_path, "w") as cache_file:
+        json.dump({"version": data_version, "body": body}, cache_file)
+    # Readers on other containers never see a half written entry
+    os.replace(temporary_file_path, cache_file_path)
+
+def _put_in_memory(cache_key, data_version, body):
+    with _memory_cache_lock:
+        _memory_cache[cache_key] = (data_version, body)
+        _memory_cache.move_to_end(cache_key)
+        while len(_memory_cache) > REPORTS_CACHE_MAX_ENTRIES:
+            _memory_cache.popitem(last=False)
+
+def get(cache_key, data_version):
+    """Returns the cached body for the key if it was computed at data_version, otherwise None"""
+    with _memory_cache_lock:
+        entry = _memory_cache.get(cache_key)
+        if entry and entry[0] == data_version:
+            _memory_cache.move_to_end(cache_key)
+            report_cache_stats["memory_hits"] += 1
+            return entry[1]
+
+    if REPORTS_CACHE_DIR:
+        body = _get_from_file(cache_key, data_version)
+        if body is not None:
+            report_cache_stats["file_hits"] += 1
+            _put_in_memory(cache_key, data_version, body)
+            return body
+
+    report_cache_stats["misses"] += 1
+    return None
+
+def put(cache_key, data_version, body):
+    _put_in_memory(cache_key, data_version, body)
+    if REPORTS_CACHE_DIR:
+        try:
+            _put_in_file(cache_key, data_version, body)
+        except OSError as e:
+            print(f"Report cache file not written: {e}")
@@ -1,80 +1,303 @@
 
-from database_commons import get_db_connection, get_json_results_from_db
-from api_commons import form_response
+import os
+import json
+import base64
+import binascii
+from datetime import date, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from psycopg2 import sql
+import report_cache
+from database_commons import open_server_side_cursor, get_data_version, log_pool_metrics
+from api_commons import form_response, handle_exception, get_header, encode_cursor_rows, RESPONSE_CONTENT_TYPES, JSON_LAYOUTS
+
+DEFAULT_REPORT_YEAR = 2021
+REPORT_PAGE_MAX_LIMIT = int(os.getenv("REPORT_PAGE_MAX_LIMIT", "10000"))
+
+# Whole years are read from the pre-aggregated tables in sql/001_report_tables.sql
+# and all-time totals from sql/006_report_total_hires.sql,
+# kept up to date by staging_to_modeled and POST /employees. Date ranges query
+# hired_employees through the index in sql/003_hired_employees_indexes.sql.
 def run(event, _):
-    supported_resources_to_handler = {
-        "/employees_by_department": get_employees_hired_by_department,
-        "/abover_average_departments": get_above_average_departments
-    }
-    resource = event["resource"]
-    result = supported_resources_to_handler[resource]()
-    return form_response(result)
+    try:
+        supported_resources_to_report = {
+            "/employees_by_department": {
+                "build_query": build_employees_hired_by_department_query,
+                "order_by": [("department", "asc"), ("job", "asc")]
+            },
+            "/abover_average_departments": {
+                "build_query": build_above_average_departments_query,
+                "order_by": [("hired", "desc"), ("id", "asc")]
+            }
+        }
+        resource = event["resource"]
+        report = supported_resources_to_report[resource]
+        parameters = event.get("queryStringParameters") or {}
+        filters = parse_report_filters(parameters)
+        page_options = parse_page_options(parameters, report["order_by"])
+        data_version, updated_at = get_data_version()
+        cache_key = report_cache.build_cache_key(resource, {**filters, **page_options})
+        headers = get_cache_headers(cache_key, data_version, updated_at)
+        if is_not_modified(event, headers, updated_at):
+            return form_response("", 304, headers=headers, encoded=True)
+
+        page = report_cache.get(cache_key, data_version)
+        if page is None:
+            page = get_report_page(report, filters, page_options)
+            report_cache.put(cache_key, data_version, page)
+        headers.update(page["headers"])
+        accept_encoding = get_header(event, "Accept-Encoding") or ""
+        return form_response(page["body"], headers=headers, encoded=True, accept_encoding=accept_encoding)
+    except AssertionError as e:
+        return handle_exception(e, 400)
+    except Exception as e:
+        return handle_exception(e, 500)
+    finally:
+        log_pool_metrics()
+
+def get_report_page(report, filters, page_options):
+    """Streams the report rows from a server side cursor into the requested format"""
+    limit = page_options.get("limit")
+    query = paginate_query(report["build_query"](filters), report["order_by"], page_options.get("cursor"), limit)
+    parameters = {**filters, **get_cursor_parameters(page_options.get("cursor"))}
+    with open_server_side_cursor(query, parameters) as cursor:
+        body, last_row, has_more = encode_cursor_rows(cursor, page_options["format"], limit, page_options["layout"])
+        columns = [column[0] for column in cursor.description or []]
+
+    headers = {"Content-Type": RESPONSE_CONTENT_TYPES[page_options["format"]]}
+    if has_more:
+        cursor_values = [last_row[columns.index(column)] for column, _ in report["order_by"]]
+        headers["X-Next-Cursor"] = encode_page_cursor(cursor_values)
+    return {"body": body, "headers": headers}
+
+def encode_page_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+def decode_page_cursor(page_cursor, order_by):
+    """Values of the order_by columns in the last row of the previous page
+
+    Cursors are sent by clients, anything but one scalar per order_by column is rejected.
+    """
+    invalid_cursor = "Invalid cursor, use the X-Next-Cursor header of the previous page"
+    try:
+        values = json.loads(base64.urlsafe_b64decode(page_cursor.encode("ascii")))
+    except (ValueError, binascii.Error):
+        raise AssertionError(invalid_cursor)
+    assert isinstance(values, list) and len(values) == len(order_by), invalid_cursor
+    assert all(value is None or isinstance(value, (str, int, float)) for value in values), invalid_cursor
+    return values
+
+def parse_page_options(parameters, order_by):
+    """Validates format, layout, limit and cursor, pages are only used when limit is sent"""
+    response_format = parameters.get("format", "json")
+    assert response_format in RESPONSE_CONTENT_TYPES, f"format must be one of {', '.join(RESPONSE_CONTENT_TYPES)}"
+    layout = parameters.get("layout", "rows")
+    assert layout in JSON_LAYOUTS, f"layout must be one of {', '.join(JSON_LAYOUTS)}"
+    assert layout == "rows" or response_format == "json", "layout=columns is only supported with format=json"
+    page_options = {"format": response_format, "layout": layout}
+    if "limit" in parameters:
+        limit = parameters["limit"]
+        assert limit.isdigit() and 1 <= int(limit) <= REPORT_PAGE_MAX_LIMIT, \
+            f"limit must be between 1 and {REPORT_PAGE_MAX_LIMIT}"
+        page_options["limit"] = int(limit)
+    if parameters.get("cursor"):
+        assert "limit" in page_options, "cursor must be sent with limit"
+        page_options["cursor"] = decode_page_cursor(parameters["cursor"], order_by)
+    return page_options
+
+def get_cursor_parameters(cursor_values):
+    """Query parameters of the cursor placeholders in paginate_query"""
+    return {f"cursor_{position}": value for position, value in enumerate(cursor_values or [])}
+
+def _get_after_cursor_condition(order_by, cursor_values):
+    """Keyset condition for the rows after the cursor, for any mix of sort directions
+
+    Values are cursor_<position> placeholders, see get_cursor_parameters. Inlined
+    literals would go through the %-formatting of the query parameters.
+    """
+    assert len(cursor_values) == len(order_by), "Invalid cursor, use the X-Next-Cursor header of the previous page"
+    alternatives = []
+    for position, (column, direction) in enumerate(order_by):
+        conditions = [
+            sql.SQL("{} = {}").format(sql.Identifier("report", previous_column), sql.Placeholder(f"cursor_{previous}"))
+            for previous, (previous_column, _) in enumerate(order_by[:position])
+        ]
+        operator = sql.SQL(">" if direction == "asc" else "<")
+        conditions.append(
+            sql.SQL("{} {} {}").format(sql.Identifier("report", column), operator, sql.Placeholder(f"cursor_{position}"))
+        )
+        alternatives.append(sql.SQL("({})").format(sql.SQL(" and ").join(conditions)))
+    return sql.SQL("({})").format(sql.SQL(" or ").join(alternatives))
+
+def paginate_query(query, order_by, cursor_values=None, limit=None):
+    conditions = [sql.SQL("true")]
+    if cursor_values is not None:
+        conditions.append(_get_after_cursor_condition(order_by, cursor_values))
+    order = sql.SQL(", ").join(
+        sql.SQL("{} {}").format(sql.Identifier("report", column), sql.SQL(direction))
+        for column, direction in order_by
+    )
+    # One extra row tells whether there is a next page
+    limit_clause = sql.SQL("limit {}").format(sql.Literal(limit + 1)) if limit else sql.SQL("")
+    return sql.SQL("select * from ({query}) report where {conditions} order by {order} {limit}").format(
+        query=query,
+        conditions=sql.SQL(" and ").join(conditions),
+        order=order,
+        limit=limit_clause
+    )
 
-def get_employees_hired_by_department():
-    sql = """
+def _parse_date(value, name):
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise AssertionError(f"{name} must be a YYYY-MM-DD date")
+
+def parse_report_filters(parameters):
+    """Validates the query string of the reports
+
+    Supports year, or start_date and end_date (both inclusive), plus department
+    and job names. Without a period the report covers DEFAULT_REPORT_YEAR.
+    """
+    filters = {}
+    start_date = parameters.get("start_date")
+    end_date = parameters.get("end_date")
+    if start_date or end_date:
+        assert "year" not in parameters, "Use either year or start_date and end_date"
+        assert start_date and end_date, "start_date and end_date must be sent together"
+        filters["start_date"] = _parse_date(start_date, "start_date")
+        filters["end_date"] = _parse_date(end_date, "end_date") + timedelta(days=1)
+        assert filters["start_date"] < filters["end_date"], "start_date must not be after end_date"
+    else:
+        year = parameters.get("year", DEFAULT_REPORT_YEAR)
+        assert str(year).isdigit() and 1900 <= int(year) <= 9999, "year must be a four digit year"
+        filters["year"] = int(year)
+
+    for name in ("department", "job"):
+        if parameters.get(name):
+            filters[name] = parameters[name]
+    return filters
+
+def _get_hires_source(filters, by_job=True):
+    """Query with department_id, job_id, quarter and hired for the period in the filters"""
+    if "year" in filters and by_job:
+        return sql.SQL("""
+            select department_id, job_id, quarter, hired
+            from public.report_hires_by_department_job_quarter
+            where year = {year}
+        """).format(year=sql.Placeholder("year"))
+    if "year" in filters:
+        return sql.SQL("""
+            select department_id, null::integer as job_id, null::integer as quarter, hired
+            from public.report_hires_by_department_year
+            where year = {year}
+        """).format(year=sql.Placeholder("year"))
+    return sql.SQL("""
+        select department_id, job_id, extract(quarter from hired_datetime)::integer as quarter, 1 as hired
+        from public.hired_employees
+        where hired_datetime >= {start_date} and hired_datetime < {end_date}
+    """).format(start_date=sql.Placeholder("start_date"), end_date=sql.Placeholder("end_date"))
+
+def _get_all_time_hires_source(filters):
+    """All-time counts, including the employees without hired_datetime, see sql/006_report_total_hires.sql"""
+    if "job" in filters:
+        return sql.SQL("select department_id, job_id, hired from public.report_total_hires_by_department_job")
+    return sql.SQL("select department_id, null::integer as job_id, hired from public.report_total_hires_by_department")
+
+def _get_name_conditions(filters):
+    conditions = [sql.SQL("true")]
+    if "department" in filters:
+        conditions.append(sql.SQL("departments.department = {}").format(sql.Placeholder("department")))
+    if "job" in filters:
+        conditions.append(sql.SQL("jobs.job = {}").format(sql.Placeholder("job")))
+    return sql.SQL(" and ").join(conditions)
+
+def build_employees_hired_by_department_query(filters):
+    query = sql.SQL("""
         select
-            department, 
-            job,
-            sum(case 
-                    when date_part('quarter', hired_datetime) = 1 then 1
-                    else 0
-                end) as "Q1",
-            sum(case 
-                    when date_part('quarter', hired_datetime) = 2 then 1
-                    else 0
-                end) as "Q2",
-            sum(case 
-                    when date_part('quarter', hired_datetime) = 3 then 1
-                    else 0
-                end) as "Q3",
-            sum(case 
-                    when date_part('quarter', hired_datetime) = 4 then 1
-                    else 0
-                end) as "Q4"
-        from
-        (
-            select 
             departments.department as department,
-            jobs.job  as job,
-            hired_datetime 
-            from 
-            public.hired_employees employees join public.departments departments 
-            on employees.department_id  = departments.id 
-            and hired_datetime < '2022-01-01' and hired_datetime >= '2021-01-01'
-            join public.jobs jobs 
-            on employees.job_id = jobs.id
-        ) filtered_employees
-        group by department, job
-        order by department, job
-    """
-    return get_json_results_from_db(sql)
-    
-def get_above_average_departments():
-    sql = """
-    with mean_employees as (
-	select avg(department_hire_count) as average_hire
-        from (
-            select 
-            count(*) as department_hire_count,
-            departments.department
-            from
-            public.hired_employees employees join public.departments departments 
-            on employees.department_id  = departments.id  and
-            hired_datetime < '2022-01-01' and hired_datetime >= '2021-01-01'
-            group by department
-        ) hires_by_department
+            jobs.job as job,
+            sum(case when hires.quarter = 1 then hires.hired else 0 end)::bigint as "Q1",
+            sum(case when hires.quarter = 2 then hires.hired else 0 end)::bigint as "Q2",
+            sum(case when hires.quarter = 3 then hires.hired else 0 end)::bigint as "Q3",
+            sum(case when hires.quarter = 4 then hires.hired else 0 end)::bigint as "Q4"
+        from
+        ({hires}) hires
+        join public.departments departments
+        on hires.department_id = departments.id
+        join public.jobs jobs
+        on hires.job_id = jobs.id
+        where {conditions}
+        group by departments.department, jobs.job
+    """).format(hires=_get_hires_source(filters), conditions=_get_name_conditions(filters))
+    return query
+
+def build_above_average_departments_query(filters):
+    conditions = _get_name_conditions(filters)
+    query = sql.SQL("""
+    with hires_by_department as (
+        select
+        hires.department_id,
+        sum(hires.hired) as department_hire_count
+        from ({hires}) hires
+        join public.departments departments
+        on hires.department_id = departments.id
+        left join public.jobs jobs
+        on hires.job_id = jobs.id
+        where {conditions}
+        group by hires.department_id
+    ),
+    mean_employees as (
+        select avg(department_hire_count) as average_hire
+        from hires_by_department
+    ),
+    department_hires as (
+        select
+        hires.department_id,
+        sum(hires.hired)::bigint as hired
+        from ({all_time_hires}) hires
+        join public.departments departments
+        on hires.department_id = departments.id
+        left join public.jobs jobs
+        on hires.job_id = jobs.id
+        where {conditions}
+        group by hires.department_id
     )
-    select 
+    select
     departments.id,
     departments.department,
-    count(*) as hired
-    from 
-    public.hired_employees employees join public.departments departments 
-    on employees.department_id  = departments.id
-    group by departments.id, departments.department
-    having count(*) > (select average_hire from mean_employees)
-    order by hired desc
-    """
-    return get_json_results_from_db(sql)
+    department_hires.hired
+    from
+    department_hires join public.departments departments
+    on department_hires.department_id = departments.id
+    where department_hires.hired > (select average_hire from mean_employees)
+    """).format(
+        hires=_get_hires_source(filters, by_job="job" in filters),
+        all_time_hires=_get_all_time_hires_source(filters),
+        conditions=conditions
+    )
+    return query
+
+def get_cache_headers(cache_key, data_version, updated_at):
+    return {
+        # Weak, so the same tag is valid for the gzip, br and identity encodings
+        "ETag": f'W/"{data_version}-{cache_key[:16]}"',
+        "Last-Modified": format_datetime(updated_at.astimezone(timezone.utc), usegmt=True),
+        "Cache-Control": "no-cache"
+    }
 
+def is_not_modified(event, headers, updated_at):
+    if_none_match = get_header(event, "If-None-Match")
+    if if_none_match:
+        etag = headers["ETag"].removeprefix("W/")
+        return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
 
+    if_modified_since = get_header(event, "If-Modified-Since")
+    if if_modified_since:
+        try:
+            modified_since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if modified_since.tzinfo is None:
+            modified_since = modified_since.replace(tzinfo=timezone.utc)
+        # HTTP dates have second precision
+        return updated_at.replace(microsecond=0) <= modified_since
+    return False
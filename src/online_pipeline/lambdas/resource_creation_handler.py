@@ -1,58 +1,167 @@
+import os
 import json
-from database_commons import get_db_connection
-from api_commons import form_response, handle_exception
+import psycopg2
+from database_commons import borrow_db_connection, bump_data_version, log_pool_metrics
+from api_commons import form_response, handle_exception, iter_request_records, iter_chunks, get_query_parameter
+from dimensions_cache import resolve_dimension_ids
 import psycopg2.extras as extras
 
+# Department and job names are resolved before the insert, see dimensions_cache.
+# The rows get no hired_datetime, so only the all-time report tables are incremented,
+# in the same statement. The yearly report tables only count dated hires.
+BULK_INSERT_EMPLOYEES_SQL = """
+    with inserted_employees as (
+        insert into hired_employees (name, department_id, job_id)
+        values %s
+        returning department_id, job_id
+    ),
+    department_totals as (
+        insert into report_total_hires_by_department (department_id, hired)
+        select department_id, count(*)
+        from inserted_employees
+        where department_id is not null
+        group by 1
+        on conflict (department_id) do
+        update
+            set hired = report_total_hires_by_department.hired + EXCLUDED.hired
+    )
+    insert into report_total_hires_by_department_job (department_id, job_id, hired)
+    select department_id, job_id, count(*)
+    from inserted_employees
+    where department_id is not null and job_id is not null
+    group by 1, 2
+    on conflict (department_id, job_id) do
+    update
+        set hired = report_total_hires_by_department_job.hired + EXCLUDED.hired
+"""
+EMPLOYEE_VALUES_TEMPLATE = "(%(name)s, %(department_id)s, %(job_id)s)"
+
+# Payloads are validated and inserted chunk by chunk, so memory depends on the chunk size only
+EMPLOYEES_CHUNK_SIZE = int(os.getenv("EMPLOYEES_CHUNK_SIZE", "1000"))
+MAX_EMPLOYEES_PER_REQUEST = int(os.getenv("MAX_EMPLOYEES_PER_REQUEST", "50000"))
+
 def request_handling_facade(event, _):
     try:
         supported_resources_to_handler = {
             "/employees": create_employees,
         }
         resource = event["resource"]
-        request_body = event["body"]
-        request_body = request_body if isinstance(request_body, dict) else json.loads(request_body)
-        result = supported_resources_to_handler[resource](request_body)
-        return form_response(result)
-    except AssertionError as e:
+        records = iter_request_records(event)
+        # With ?mode=partial valid rows are committed and invalid ones are reported back
+        partial = get_query_parameter(event, "mode") == "partial"
+        result = supported_resources_to_handler[resource](records, partial=partial)
+        code = 207 if result.get("errors") else 200
+        return form_response(result, code)
+    except (AssertionError, json.JSONDecodeError) as e:
         return handle_exception(e, 400)
     except Exception as e:
         return handle_exception(e, 500)
+    finally:
+        log_pool_metrics()
 
-def create_employees(employees):
-    for employee in employees:
-        assert "name" in employee \
-        and "department" in employee \
-        and "job" in employee, "The employee must have name, department and job, check the payload"
-    
-    assert len(employees) <= 1000, "The maximum batch size is 1000, please fix the payload"
-    batch_insert_sql = """
-        with mapped_departments_employee as (
-        SELECT temp_employee.*, d.id AS department_id
-        FROM  (
-            VALUES
-                (%(name)s, %(department)s, %(job)s)
-                
-            ) temp_employee (name, department, job)
-        LEFT JOIN departments d on d.department  = temp_employee.department
-    ),
-    mapped_jobs_employee as (
-        SELECT mapped_departments_employee.*, j.id AS job_id
-        FROM  mapped_departments_employee
-        LEFT JOIN jobs j on j.job  = mapped_departments_employee.job
-    )
-    insert into hired_employees (name, department_id, job_id)
-    select name, department_id, job_id from mapped_jobs_employee
-    """
+def _get_employee_error(employee):
+    if not isinstance(employee, dict):
+        return "The employee must be a JSON object"
+    missing_fields = [field for field in ("name", "department", "job") if field not in employee]
+    if missing_fields:
+        return f"Missing fields: {', '.join(missing_fields)}"
+    # Names are looked up in dimensions_cache, other JSON types cannot be resolved
+    non_string_fields = [field for field in ("name", "department", "job") if not isinstance(employee[field], str)]
+    if non_string_fields:
+        return f"Fields must be strings: {', '.join(non_string_fields)}"
+    return None
+
+def validate_employees(employees, first_index=0):
+    for index, employee in enumerate(employees, start=first_index):
+        assert _get_employee_error(employee) is None, \
+            f"The employee at index {index} must have name, department and job as strings, check the payload"
+
+def split_invalid_employees(employees, first_index=0):
+    valid_employees = []
+    valid_indexes = []
+    errors = []
+    for index, employee in enumerate(employees, start=first_index):
+        error = _get_employee_error(employee)
+        if error:
+            errors.append({"index": index, "reason": error})
+        else:
+            valid_employees.append(employee)
+            valid_indexes.append(index)
+    return valid_employees, valid_indexes, errors
+
+def create_employees(employees, partial=False):
+    inserted_employees = 0
+    errors = []
     try:
-        connection = get_db_connection()
-        with connection:
+        with borrow_db_connection() as connection:
             with connection.cursor() as cur:
-                extras.execute_batch(cur, batch_insert_sql, employees)
-        connection.commit()
+                for first_index, chunk in iter_chunks(employees, EMPLOYEES_CHUNK_SIZE):
+                    assert first_index + len(chunk) <= MAX_EMPLOYEES_PER_REQUEST, \
+                        f"The maximum batch size is {MAX_EMPLOYEES_PER_REQUEST}, please fix the payload"
+                    if partial:
+                        inserted_employees += _create_employees_chunk_partially(cur, chunk, first_index, errors)
+                    else:
+                        inserted_employees += _create_employees_chunk(cur, chunk, first_index)
+                if inserted_employees:
+                    bump_data_version(cur)
     except Exception as e:
         print(e)
         raise e
     else:
-        return {"result": "Batch inserted correctly"}
-    finally:
-        connection.close()
\ No newline at end of file
+        result = {"result": "Batch inserted correctly", "inserted": inserted_employees}
+        if partial:
+            result["errors"] = sorted(errors, key=lambda error: error["index"])
+            if errors:
+                result["result"] = "Batch inserted partially, check the errors"
+        return result
+
+def _create_employees_chunk(cursor, employees, first_index):
+    validate_employees(employees, first_index)
+    indexes = range(first_index, first_index + len(employees))
+    resolved_employees, errors = resolve_dimension_ids(employees, indexes, cursor.connection)
+    assert not errors, f"Unknown departments or jobs, check the payload: {errors}"
+    insert_employees(cursor, resolved_employees)
+    return len(resolved_employees)
+
+def _create_employees_chunk_partially(cursor, employees, first_index, errors):
+    valid_employees, valid_indexes, validation_errors = split_invalid_employees(employees, first_index)
+    errors.extend(validation_errors)
+    resolved_employees, dimension_errors = resolve_dimension_ids(valid_employees, valid_indexes, cursor.connection)
+    errors.extend(dimension_errors)
+    return insert_employees_isolating_failures(cursor, resolved_employees, errors)
+
+def insert_employees_isolating_failures(cursor, employees, errors):
+    """Inserts the rows that the database accepts and reports the rest in errors
+
+    A failing insert is rolled back to a savepoint and split in halves until the
+    offending rows are isolated, so a single bad row costs about log2(n) retries
+    instead of one insert per row.
+    """
+    if not employees:
+        return 0
+    cursor.execute("savepoint insert_employees")
+    try:
+        insert_employees(cursor, employees)
+    except psycopg2.Error as e:
+        cursor.execute("rollback to savepoint insert_employees")
+        if len(employees) == 1:
+            reason = e.diag.message_primary or str(e)
+            errors.append({"index": employees[0]["index"], "reason": reason})
+            return 0
+        middle = len(employees) // 2
+        return insert_employees_isolating_failures(cursor, employees[:middle], errors) \
+            + insert_employees_isolating_failures(cursor, employees[middle:], errors)
+    else:
+        cursor.execute("release savepoint insert_employees")
+        return len(employees)
+
+def insert_employees(cursor, employees):
+    if not employees:
+        return
+    extras.execute_values(
+        cursor,
+        BULK_INSERT_EMPLOYEES_SQL,
+        employees,
+        template=EMPLOYEE_VALUES_TEMPLATE,
+        page_size=len(employees)
+    )
@@ -0,0 +1,70 @@
+import os
+import uuid
+
+import pytest
+
+# The tables of the modeled schema the handlers write to
+BASE_SCHEMA = """
+create table departments (id integer primary key, department text);
+create table jobs (id integer primary key, job text);
+create table hired_employees (
+    id serial primary key,
+    name text,
+    hired_datetime timestamp,
+    department_id integer,
+    job_id integer,
+    unique (hired_datetime, name, department_id, job_id)
+);
+"""
+
+@pytest.fixture
+def cursor():
+    """Cursor on a scratch Postgres database in TEST_DATABASE_URL with the base schema
+
+    Everything runs in one transaction that is rolled back afterwards.
+    """
+    psycopg2 = pytest.importorskip("psycopg2")
+    database_url = os.getenv("TEST_DATABASE_URL")
+    if not database_url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    connection = psycopg2.connect(database_url)
+    try:
+        with connection.cursor() as cur:
+            cur.execute(BASE_SCHEMA)
+            yield cur
+    finally:
+        connection.rollback()
+        connection.close()
+
+@pytest.fixture
+def connect_to_scratch_schema():
+    """Opens connections whose search_path is a scratch schema in TEST_DATABASE_URL
+
+    For code that commits its own transactions. The schema starts with the base
+    schema and is dropped with everything in it afterwards.
+    """
+    psycopg2 = pytest.importorskip("psycopg2")
+    database_url = os.getenv("TEST_DATABASE_URL")
+    if not database_url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    schema = f"test_{uuid.uuid4().hex}"
+    admin_connection = psycopg2.connect(database_url)
+    admin_connection.autocommit = True
+    with admin_connection.cursor() as cur:
+        cur.execute(f"create schema {schema}")
+
+    def connect():
+        return psycopg2.connect(database_url, options=f"-c search_path={schema}")
+
+    connection = connect()
+    try:
+        with connection, connection.cursor() as cur:
+            cur.execute(BASE_SCHEMA)
+    finally:
+        connection.close()
+    try:
+        yield connect
+    finally:
+        with admin_connection.cursor() as cur:
+            cur.execute(f"drop schema {schema} cascade")
+        admin_connection.close()
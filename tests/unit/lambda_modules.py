@@ -0,0 +1,33 @@
+import importlib
+import os
+import sys
+
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..", "..")
+LAMBDAS_DIRS = {
+    "online": os.path.abspath(os.path.join(ROOT_DIR, "src", "online_pipeline", "lambdas")),
+    "batch": os.path.abspath(os.path.join(ROOT_DIR, "src", "batch_pipeline", "lambdas"))
+}
+
+def _get_lambda_module_names():
+    return {
+        file_name[:-3]
+        for lambdas_dir in LAMBDAS_DIRS.values()
+        for file_name in os.listdir(lambdas_dir)
+        if file_name.endswith(".py")
+    }
+
+def load_lambda_modules(pipeline, *names):
+    """Imports handler modules of one pipeline
+
+    Both pipelines have an api_commons and a database_commons, so the modules of
+    the other pipeline are dropped from sys.modules first. The lambdas directory
+    is appended, so the installed psycopg2 wins over the one vendored for Lambda.
+    """
+    for lambdas_dir in LAMBDAS_DIRS.values():
+        while lambdas_dir in sys.path:
+            sys.path.remove(lambdas_dir)
+    for module_name in _get_lambda_module_names():
+        sys.modules.pop(module_name, None)
+    sys.path.append(LAMBDAS_DIRS[pipeline])
+    modules = [importlib.import_module(name) for name in names]
+    return modules[0] if len(modules) == 1 else modules
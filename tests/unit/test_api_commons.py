@@ -0,0 +1,121 @@
+import gzip
+import base64
+import decimal
+import datetime
+import json
+
+import pytest
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+api_commons = load_lambda_modules("online", "api_commons")
+
+RECORDS = [
+    {"name": "Ana", "department": "Sales", "job": "Analyst"},
+    {"name": "Bob", "department": "Legal", "job": "Manager"}
+]
+
+def test_iter_request_records_reads_a_json_array():
+    event = {"body": " [\n" + ",\n".join(json.dumps(record) for record in RECORDS) + "\n] "}
+    assert list(api_commons.iter_request_records(event)) == RECORDS
+
+def test_iter_request_records_reads_an_empty_json_array():
+    assert list(api_commons.iter_request_records({"body": "[ ]"})) == []
+
+def test_iter_request_records_reads_ndjson():
+    event = {
+        "headers": {"content-type": "application/x-ndjson; charset=utf-8"},
+        "body": "\n".join(json.dumps(record) for record in RECORDS) + "\n\n"
+    }
+    assert list(api_commons.iter_request_records(event)) == RECORDS
+
+def test_iter_request_records_decodes_base64_bodies():
+    event = {"isBase64Encoded": True, "body": base64.b64encode(json.dumps(RECORDS).encode("utf-8")).decode("ascii")}
+    assert list(api_commons.iter_request_records(event)) == RECORDS
+
+def test_iter_request_records_yields_records_before_reading_the_rest():
+    records = api_commons.iter_request_records({"body": json.dumps(RECORDS[:1])[:-1] + ", not json]"})
+    assert next(records) == RECORDS[0]
+    with pytest.raises(ValueError):
+        next(records)
+
+@pytest.mark.parametrize("body", ['{"name": "Ana"}', "[1, 2", "[1 2]", "[1] [2]"])
+def test_iter_request_records_rejects_malformed_json_arrays(body):
+    with pytest.raises((AssertionError, ValueError)):
+        list(api_commons.iter_request_records({"body": body}))
+
+class FakeCursor:
+    """Iterates over rows like a psycopg2 cursor, description has (name, type_code) pairs"""
+
+    def __init__(self, description, rows):
+        self.description = description
+        self.rows = rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+REPORT_DESCRIPTION = [("department", 25), ("hired", 1700), ("updated_at", 1082)]
+REPORT_ROWS = [("Legal", decimal.Decimal("4"), datetime.date(2021, 1, 2)), ("Sales", decimal.Decimal("2.5"), None)]
+
+@pytest.mark.parametrize("response_format, layout, expected_body", [
+    ("json", "rows", [
+        {"department": "Legal", "hired": 4, "updated_at": "2021-01-02"},
+        {"department": "Sales", "hired": 2.5, "updated_at": None}
+    ]),
+    ("json", "columns", {
+        "columns": ["department", "hired", "updated_at"],
+        "data": [["Legal", 4, "2021-01-02"], ["Sales", 2.5, None]]
+    })
+])
+def test_encode_cursor_rows_encodes_json_layouts(response_format, layout, expected_body):
+    body, last_row, has_more = api_commons.encode_cursor_rows(
+        FakeCursor(REPORT_DESCRIPTION, REPORT_ROWS), response_format, layout=layout
+    )
+    assert json.loads(body) == expected_body
+    assert last_row == REPORT_ROWS[-1]
+    assert not has_more
+
+def test_encode_cursor_rows_encodes_ndjson_and_csv():
+    ndjson_body, _, _ = api_commons.encode_cursor_rows(FakeCursor(REPORT_DESCRIPTION, REPORT_ROWS), "ndjson")
+    assert [json.loads(line) for line in ndjson_body.splitlines()][1] == {
+        "department": "Sales", "hired": 2.5, "updated_at": None
+    }
+    csv_body, _, _ = api_commons.encode_cursor_rows(FakeCursor(REPORT_DESCRIPTION, REPORT_ROWS), "csv")
+    assert csv_body == "department,hired,updated_at\nLegal,4,2021-01-02\nSales,2.5,\n"
+
+def test_encode_cursor_rows_stops_at_the_limit_across_batches(monkeypatch):
+    monkeypatch.setattr(api_commons, "ENCODE_BATCH_SIZE", 3)
+    rows = [(index,) for index in range(10)]
+    body, last_row, has_more = api_commons.encode_cursor_rows(FakeCursor([("id", 23)], rows), limit=7)
+    assert json.loads(body) == [{"id": index} for index in range(7)]
+    assert last_row == (6,)
+    assert has_more
+
+def test_encode_cursor_rows_encodes_empty_results():
+    body, last_row, has_more = api_commons.encode_cursor_rows(FakeCursor([("id", 23)], []), layout="columns")
+    assert json.loads(body) == {"columns": ["id"], "data": []}
+    assert last_row is None and not has_more
+
+@pytest.mark.parametrize("accept_encoding, expected_encoding", [
+    ("gzip, deflate", "gzip"),
+    ("gzip;q=0, identity", None),
+    ("*", "br" if api_commons.brotli else "gzip"),
+    ("br;q=0.5, gzip;q=0.8", "gzip"),
+    ("", None)
+])
+def test_choose_content_encoding_follows_the_client_preferences(accept_encoding, expected_encoding):
+    assert api_commons.choose_content_encoding(accept_encoding) == expected_encoding
+
+def test_form_response_compresses_large_bodies():
+    body = json.dumps(RECORDS * 100)
+    response = api_commons.form_response(body, encoded=True, accept_encoding="gzip")
+    assert response["isBase64Encoded"]
+    assert response["headers"]["Content-Encoding"] == "gzip"
+    assert response["headers"]["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(base64.b64decode(response["body"])).decode("utf-8") == body
+
+def test_form_response_leaves_small_bodies_uncompressed():
+    response = api_commons.form_response({"result": "ok"}, accept_encoding="gzip")
+    assert not response["isBase64Encoded"]
+    assert "Content-Encoding" not in response["headers"]
+    assert json.loads(response["body"]) == {"result": "ok"}
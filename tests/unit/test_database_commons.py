@@ -0,0 +1,97 @@
+import threading
+import time
+
+import pytest
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.pool import PoolError
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+database_commons = load_lambda_modules("online", "database_commons")
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = 0
+        self.info = type("ConnectionInfo", (), {"transaction_status": TRANSACTION_STATUS_IDLE})()
+
+    def close(self):
+        self.closed = 1
+
+    def rollback(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+@pytest.fixture
+def opened_connections(monkeypatch):
+    connections = []
+
+    def connect(event=None):
+        connections.append(FakeConnection())
+        return connections[-1]
+    monkeypatch.setattr(database_commons, "get_db_connection", connect)
+    monkeypatch.setattr(database_commons, "_is_connection_alive", lambda connection: True)
+    return connections
+
+def build_provider(max_connections=2, checkout_timeout=1.0, max_connection_age=60.0):
+    return database_commons.PooledConnectionProvider(1, max_connections, checkout_timeout, max_connection_age)
+
+def test_concurrent_checkouts_reuse_connections(opened_connections):
+    provider = build_provider(max_connections=2)
+    barrier = threading.Barrier(2)
+
+    def borrow(_):
+        with provider.connection():
+            # Both slots are held at once at least once per round
+            barrier.wait(timeout=5)
+
+    for _ in range(3):
+        threads = [threading.Thread(target=borrow, args=(index,)) for index in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert len(opened_connections) == 2
+    assert not any(connection.closed for connection in opened_connections)
+    metrics = provider.get_metrics()
+    assert metrics["checkouts"] == 6
+    assert metrics["peak_in_use"] == 2
+    assert metrics["recycled_connections"] == 0
+
+def test_checkout_times_out_when_every_connection_is_lent(opened_connections):
+    provider = build_provider(max_connections=1, checkout_timeout=0.05)
+    with provider.connection():
+        with pytest.raises(PoolError):
+            with provider.connection():
+                pass
+    assert provider.get_metrics()["checkout_timeouts"] == 1
+    with provider.connection() as connection:
+        assert connection is opened_connections[0]
+
+def test_expired_connections_are_replaced(opened_connections):
+    provider = build_provider(max_connections=2, max_connection_age=0.05)
+    with provider.connection() as first_connection:
+        pass
+    time.sleep(0.1)
+    with provider.connection() as second_connection:
+        pass
+
+    assert second_connection is not first_connection
+    assert first_connection.closed
+    assert provider.get_metrics()["recycled_connections"] == 1
+    # Closed connections do not stay in the creation times
+    assert list(provider._created_at) == [id(second_connection)]
+
+def test_closed_connections_are_not_lent_again(opened_connections):
+    provider = build_provider(max_connections=2)
+    with provider.connection() as connection:
+        connection.close()
+    with provider.connection() as next_connection:
+        assert next_connection is not connection
+    assert provider.get_metrics()["recycled_connections"] == 1
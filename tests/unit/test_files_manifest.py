@@ -0,0 +1,16 @@
+import pytest
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+files_manifest = load_lambda_modules("batch", "files_manifest")
+
+PREFIX = "hr/departments/unprocessed/"
+
+@pytest.mark.parametrize("watermark, expected_start_after", [
+    (PREFIX + "20240101T060000123Z-departments.csv", PREFIX + "20240101T000000123Z"),
+    (PREFIX + "departments.csv", None),
+    ("hr/jobs/unprocessed/20240101T060000123Z-jobs.csv", None),
+    (None, None)
+])
+def test_listings_start_a_lag_window_before_the_watermark(watermark, expected_start_after):
+    assert files_manifest.get_listing_start_after(PREFIX, watermark, 6 * 60 * 60) == expected_start_after
@@ -1,15 +1,22 @@
-import aws_cdk as core
-import aws_cdk.assertions as assertions
+import json
+import pathlib
 
-from globant_challenge.globant_challenge_stack import GlobantChallengeStack
+import pytest
 
-# example tests. To run these tests, uncomment this file along with the example
-# resource in globant_challenge/globant_challenge_stack.py
-def test_sqs_queue_created():
-    app = core.App()
-    stack = GlobantChallengeStack(app, "globant-challenge")
+core = pytest.importorskip("aws_cdk")
+assertions = pytest.importorskip("aws_cdk.assertions")
+
+from iac.globant_challenge_stack import GlobantChallengeStack  # noqa: E402
+
+ROOT_DIR = pathlib.Path(__file__).parents[2]
+
+def test_load_hr_database_state_machine_created(monkeypatch):
+    # Lambda assets are resolved from the project root, lookups from the saved cdk.context.json
+    monkeypatch.chdir(ROOT_DIR)
+    app = core.App(context=json.loads((ROOT_DIR / "cdk.context.json").read_text()))
+    stack = GlobantChallengeStack(
+        app, "globant-challenge", env=core.Environment(account="727474809098", region="us-west-2")
+    )
     template = assertions.Template.from_stack(stack)
 
-#     template.has_resource_properties("AWS::SQS::Queue", {
-#         "VisibilityTimeout": 300
-#     })
+    template.resource_count_is("AWS::StepFunctions::StateMachine", 1)
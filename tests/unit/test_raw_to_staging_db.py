@@ -0,0 +1,222 @@
+import os
+import time
+import threading
+
+import pytest
+from botocore.exceptions import ClientError
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+raw_to_staging_db, files_manifest, metadata_store = load_lambda_modules(
+    "batch", "raw_to_staging_db", "files_manifest", "metadata_store"
+)
+
+PREFIX = "hr/departments/unprocessed/"
+
+@pytest.fixture
+def event(tmp_path):
+    (tmp_path / PREFIX).mkdir(parents=True)
+    return {
+        "source": "raw-globant-hr",
+        "domain": "hr",
+        "dataset": "departments",
+        "loader": "copy",
+        "local_source_dir": str(tmp_path),
+        "local_metadata_dir": str(tmp_path / "metadata")
+    }
+
+def write_raw_file(event, name, content):
+    with open(f"{event['local_source_dir']}/{PREFIX}{name}", "wb") as raw_file:
+        raw_file.write(content)
+    return PREFIX + name
+
+def record_imported(event, store, file_path):
+    content_hash = raw_to_staging_db.compute_content_hash(event, file_path)
+    file_report = {"file": file_path, "status": "processed", "content_hash": content_hash}
+    files_manifest.record_imported_contents(store, event, [file_report])
+
+def test_split_duplicate_files(event):
+    store = metadata_store.get_metadata_store(event)
+    imported = write_raw_file(event, "20240101T000000000Z-imported.csv", b"1,Sales\n")
+    record_imported(event, store, imported)
+    new = write_raw_file(event, "20240102T000000000Z-new.csv", b"2,Legal\n")
+    same_as_new = write_raw_file(event, "20240102T000001000Z-copy.csv", b"2,Legal\n")
+    same_as_imported = write_raw_file(event, "20240102T000002000Z-again.csv", b"1,Sales\n")
+    missing = PREFIX + "20240102T000003000Z-missing.csv"
+
+    unique_files, skipped_file_reports = raw_to_staging_db.split_duplicate_files(
+        event, store, [new, same_as_new, same_as_imported, missing, imported], 2
+    )
+
+    assert [file_path for file_path, _ in unique_files] == [new]
+    statuses = {file_report["file"]: file_report["status"] for file_report in skipped_file_reports}
+    assert statuses == {
+        same_as_new: "duplicate", same_as_imported: "duplicate", missing: "failed", imported: "processed"
+    }
+    duplicates_of = {file_report["file"]: file_report.get("duplicate_of") for file_report in skipped_file_reports}
+    assert duplicates_of[same_as_new] == new
+    assert duplicates_of[same_as_imported] == imported
+
+def test_split_duplicate_files_defers_transient_errors(event, monkeypatch):
+    store = metadata_store.get_metadata_store(event)
+    throttled = write_raw_file(event, "20240101T000000000Z-throttled.csv", b"1,Sales\n")
+
+    def throttle(event, file_path):
+        raise ClientError({"Error": {"Code": "SlowDown", "Message": "Reduce your request rate"}}, "GetObject")
+    monkeypatch.setattr(raw_to_staging_db, "compute_content_hash", throttle)
+
+    unique_files, skipped_file_reports = raw_to_staging_db.split_duplicate_files(event, store, [throttled], 1)
+    assert unique_files == []
+    assert [file_report["status"] for file_report in skipped_file_reports] == ["deferred"]
+
+def test_split_duplicate_files_reuses_known_hashes(event, monkeypatch):
+    store = metadata_store.get_metadata_store(event)
+    monkeypatch.setattr(raw_to_staging_db, "compute_content_hash", pytest.fail)
+    unique_files, _ = raw_to_staging_db.split_duplicate_files(
+        event, store, [PREFIX + "listed.csv"], 1, {PREFIX + "listed.csv": "abc"}
+    )
+    assert unique_files == [(PREFIX + "listed.csv", "abc")]
+
+def test_list_files_only_hashes_files_sharing_their_size(event, monkeypatch):
+    listed = [
+        write_raw_file(event, "20240101T000000000Z-a.csv", b"1,Sales\n"),
+        write_raw_file(event, "20240101T000001000Z-b.csv", b"2,Legal and Compliance\n"),
+        write_raw_file(event, "20240101T000002000Z-copy-a.csv", b"1,Sales\n"),
+        write_raw_file(event, "20240101T000003000Z-c.csv", b"3,Legal\n")
+    ]
+    new_files = [
+        {"key": file_path, "etag": f'"{position}"', "size": os.path.getsize(f"{event['local_source_dir']}/{file_path}")}
+        for position, file_path in enumerate(listed)
+    ]
+    monkeypatch.setattr(raw_to_staging_db, "discover_new_files", lambda event, store: new_files)
+    finished = []
+    monkeypatch.setattr(
+        raw_to_staging_db, "finish_files", lambda event, store, file_reports, s3_objects: finished.extend(file_reports)
+    )
+    hashed = []
+    compute_content_hash = raw_to_staging_db.compute_content_hash
+
+    def count_hashes(event, file_path):
+        hashed.append(file_path)
+        return compute_content_hash(event, file_path)
+    monkeypatch.setattr(raw_to_staging_db, "compute_content_hash", count_hashes)
+
+    files = raw_to_staging_db.list_files(event, None)["files"]
+
+    # a, its copy and c have the same size, b has a size of its own and is hashed by the Map worker
+    assert sorted(hashed) == sorted([listed[0], listed[2], listed[3]])
+    assert [s3_object["key"] for s3_object in files] == [listed[0], listed[1], listed[3]]
+    assert files[1]["content_hash"] is None and files[0]["content_hash"] and files[2]["content_hash"]
+    assert [(file_report["file"], file_report["status"]) for file_report in finished] == [(listed[2], "duplicate")]
+
+class FakeConnection:
+
+    def __init__(self, rollback_error=None):
+        self.closed = 0
+        self.rollback_error = rollback_error
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        if self.rollback_error:
+            raise self.rollback_error
+
+    def close(self):
+        self.closed = 1
+
+@pytest.fixture
+def worker_run(event, monkeypatch):
+    """Runs raw_to_staging_db.run on fake connections, recording which connection and thread loaded every file"""
+    monkeypatch.setattr(raw_to_staging_db, "_worker_state", threading.local())
+    connections = []
+    loads = []
+    indexed = []
+    finished = []
+    active = {"now": 0, "max": 0}
+    lock = threading.Lock()
+
+    def connect(event):
+        with lock:
+            connections.append(FakeConnection())
+            return connections[-1]
+
+    def load(event, file_path, db_connection, s3_import_credentials=None):
+        with lock:
+            active["now"] += 1
+            active["max"] = max(active["max"], active["now"])
+        time.sleep(0.02)
+        with lock:
+            active["now"] -= 1
+            loads.append((file_path, threading.get_ident(), db_connection))
+        if "broken" in file_path:
+            db_connection.rollback_error = Exception("server closed the connection unexpectedly")
+            raise Exception("server closed the connection unexpectedly")
+        return 1
+
+    def index_contents(store, event, file_reports):
+        with lock:
+            indexed.extend((file_report["file"], threading.get_ident()) for file_report in file_reports)
+
+    def move(bucket, file_reports):
+        for file_report in file_reports:
+            file_report["moved"] = True
+        finished.append([file_report["file"] for file_report in file_reports])
+
+    monkeypatch.setattr(raw_to_staging_db, "get_db_connection", connect)
+    monkeypatch.setattr(raw_to_staging_db, "load_file", load)
+    monkeypatch.setattr(raw_to_staging_db, "record_imported_contents", index_contents)
+    monkeypatch.setattr(raw_to_staging_db, "move_files", move)
+    monkeypatch.setattr(raw_to_staging_db, "record_handled_files", lambda store, event, file_reports, s3_objects: None)
+
+    def run(file_names, parallelism):
+        new_files = [
+            {"key": write_raw_file(event, file_name, file_name.encode()), "etag": f'"{file_name}"', "size": 1}
+            for file_name in file_names
+        ]
+        monkeypatch.setattr(raw_to_staging_db, "discover_new_files", lambda event, store: new_files)
+        report = raw_to_staging_db.run({**event, "parallelism": parallelism}, None)
+        return report, connections, loads, indexed, finished, active["max"]
+    return run
+
+def test_run_imports_with_a_bounded_pool_and_one_connection_per_worker(worker_run):
+    file_names = [f"20240101T00000{position}000Z-{position}.csv" for position in range(6)]
+    report, connections, loads, indexed, finished, max_active = worker_run(file_names, 2)
+
+    assert report["parallelism"] == 2 and report["processed"] == 6 and report["rows"] == 6
+    assert max_active == 2
+    connections_by_thread = {}
+    for _, thread, connection in loads:
+        assert connections_by_thread.setdefault(thread, connection) is connection
+    assert len(connections) == len(connections_by_thread) <= 2
+    assert all(connection.closed for connection in connections)
+    # Every file is timed and indexed by its worker, then all are moved in one batch
+    assert all(file_report["seconds"] >= 0.02 for file_report in report["files"])
+    assert sorted(indexed) == sorted((file_path, thread) for file_path, thread, _ in loads)
+    assert finished == [[PREFIX + file_name for file_name in file_names]]
+
+def test_run_reconnects_after_losing_the_worker_connection(worker_run):
+    report, connections, loads, _, _, _ = worker_run(["20240101T000000000Z-broken.csv", "20240101T000001000Z-next.csv"], 1)
+
+    assert [file_report["status"] for file_report in report["files"]] == ["failed", "processed"]
+    assert [connection for _, _, connection in loads] == connections
+    assert len(connections) == 2
+
+def test_get_worker_connection_is_kept_per_thread(monkeypatch):
+    monkeypatch.setattr(raw_to_staging_db, "_worker_state", threading.local())
+    monkeypatch.setattr(raw_to_staging_db, "get_db_connection", lambda event: FakeConnection())
+    opened_connections = []
+    connection = raw_to_staging_db.get_worker_connection({}, opened_connections)
+    assert raw_to_staging_db.get_worker_connection({}, opened_connections) is connection
+
+    other_thread_connections = []
+    thread = threading.Thread(
+        target=lambda: other_thread_connections.append(raw_to_staging_db.get_worker_connection({}, opened_connections))
+    )
+    thread.start()
+    thread.join()
+    assert other_thread_connections[0] is not connection
+
+    connection.close()
+    assert raw_to_staging_db.get_worker_connection({}, opened_connections) is not connection
+    assert len(opened_connections) == 3
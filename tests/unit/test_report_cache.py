@@ -0,0 +1,45 @@
+from collections import OrderedDict
+
+import pytest
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+report_cache = load_lambda_modules("online", "report_cache")
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(report_cache, "_memory_cache", OrderedDict())
+    monkeypatch.setattr(report_cache, "REPORTS_CACHE_DIR", None)
+    monkeypatch.setattr(report_cache, "report_cache_stats", {"memory_hits": 0, "file_hits": 0, "misses": 0})
+
+def test_build_cache_key_ignores_the_parameters_order():
+    assert report_cache.build_cache_key("/report", {"year": 2021, "limit": 10}) == \
+        report_cache.build_cache_key("/report", {"limit": 10, "year": 2021})
+    assert report_cache.build_cache_key("/report", {"year": 2021}) != report_cache.build_cache_key("/report", {"year": 2022})
+
+def test_entries_are_invalidated_by_a_version_bump():
+    report_cache.put("key", 1, {"body": "version 1"})
+    assert report_cache.get("key", 1) == {"body": "version 1"}
+    assert report_cache.get("key", 2) is None
+    report_cache.put("key", 2, {"body": "version 2"})
+    assert report_cache.get("key", 2) == {"body": "version 2"}
+    assert report_cache.report_cache_stats == {"memory_hits": 2, "file_hits": 0, "misses": 1}
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    monkeypatch.setattr(report_cache, "REPORTS_CACHE_MAX_ENTRIES", 2)
+    report_cache.put("first", 1, "first body")
+    report_cache.put("second", 1, "second body")
+    # Reading first makes second the least recently used entry
+    assert report_cache.get("first", 1) == "first body"
+    report_cache.put("third", 1, "third body")
+    assert list(report_cache._memory_cache) == ["first", "third"]
+    assert report_cache.get("second", 1) is None
+
+def test_file_entries_are_shared_and_versioned(monkeypatch, tmp_path):
+    monkeypatch.setattr(report_cache, "REPORTS_CACHE_DIR", str(tmp_path / "reports"))
+    report_cache.put("key", 1, "cached body")
+    # Another container starts with an empty memory cache
+    monkeypatch.setattr(report_cache, "_memory_cache", OrderedDict())
+    assert report_cache.get("key", 1) == "cached body"
+    assert report_cache.get("key", 2) is None
+    assert report_cache.report_cache_stats == {"memory_hits": 0, "file_hits": 1, "misses": 1}
@@ -0,0 +1,96 @@
+"""Compares the reports served from the report tables with the original queries, needs TEST_DATABASE_URL"""
+import pathlib
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+reports_handler, resource_creation_handler = load_lambda_modules(
+    "online", "reports_handler", "resource_creation_handler"
+)
+
+SQL_DIR = pathlib.Path(__file__).parents[2] / "sql"
+
+# The queries of reports_handler before the report tables
+BASELINE_EMPLOYEES_BY_DEPARTMENT = """
+    select department, job,
+        sum(case when date_part('quarter', hired_datetime) = 1 then 1 else 0 end) as "Q1",
+        sum(case when date_part('quarter', hired_datetime) = 2 then 1 else 0 end) as "Q2",
+        sum(case when date_part('quarter', hired_datetime) = 3 then 1 else 0 end) as "Q3",
+        sum(case when date_part('quarter', hired_datetime) = 4 then 1 else 0 end) as "Q4"
+    from (
+        select departments.department as department, jobs.job as job, hired_datetime
+        from public.hired_employees employees join public.departments departments
+        on employees.department_id = departments.id
+        and hired_datetime < '2022-01-01' and hired_datetime >= '2021-01-01'
+        join public.jobs jobs on employees.job_id = jobs.id
+    ) filtered_employees
+    group by department, job
+"""
+
+BASELINE_ABOVE_AVERAGE_DEPARTMENTS = """
+    with mean_employees as (
+        select avg(department_hire_count) as average_hire
+        from (
+            select count(*) as department_hire_count, departments.department
+            from public.hired_employees employees join public.departments departments
+            on employees.department_id = departments.id and
+            hired_datetime < '2022-01-01' and hired_datetime >= '2021-01-01'
+            group by department
+        ) hires_by_department
+    )
+    select departments.id, departments.department, count(*) as hired
+    from public.hired_employees employees join public.departments departments
+    on employees.department_id = departments.id
+    group by departments.id, departments.department
+    having count(*) > (select average_hire from mean_employees)
+"""
+
+def load_hires(cur):
+    cur.execute("insert into departments values (1, 'Sales'), (2, 'Legal'), (3, 'Support')")
+    cur.execute("insert into jobs values (1, 'Analyst'), (2, 'Manager')")
+    dated_hires = [
+        ("Ana", "2021-02-01", 1, 1), ("Bob", "2021-05-01", 1, 2), ("Cid", "2021-08-01", 1, 1),
+        ("Ada", "2021-03-01", 1, 2), ("Ben", "2021-12-01", 1, 1),
+        ("Dee", "2021-11-01", 2, 1), ("Eve", "2020-03-01", 2, 2), ("Fay", "2020-06-01", 3, 1),
+        ("Gus", "2021-01-15", 3, None)
+    ]
+    cur.executemany(
+        "insert into hired_employees (name, hired_datetime, department_id, job_id) values (%s, %s, %s, %s)",
+        dated_hires
+    )
+    cur.execute((SQL_DIR / "001_report_tables.sql").read_text())
+    cur.execute((SQL_DIR / "006_report_total_hires.sql").read_text())
+    # Created through POST /employees afterwards, without hired_datetime
+    resource_creation_handler.insert_employees(cur, [
+        {"name": "Hal", "department_id": 2, "job_id": 1},
+        {"name": "Ivy", "department_id": 2, "job_id": 2},
+        {"name": "Jon", "department_id": 2, "job_id": 1}
+    ])
+
+def fetch_report(cur, build_query, order_by, filters):
+    cur.execute(reports_handler.paginate_query(build_query(filters), order_by), filters)
+    return sorted(cur.fetchall())
+
+def test_above_average_departments_matches_the_original_query(cursor):
+    load_hires(cursor)
+    report = fetch_report(
+        cursor, reports_handler.build_above_average_departments_query, [("hired", "desc"), ("id", "asc")],
+        {"year": 2021}
+    )
+    cursor.execute(BASELINE_ABOVE_AVERAGE_DEPARTMENTS)
+    assert report == sorted(cursor.fetchall())
+    # Legal only gets above the average with the employees created without hired_datetime
+    assert [row[1] for row in report] == ["Sales", "Legal"]
+
+def test_employees_by_department_matches_the_original_query(cursor):
+    load_hires(cursor)
+    report = fetch_report(
+        cursor, reports_handler.build_employees_hired_by_department_query, [("department", "asc"), ("job", "asc")],
+        {"year": 2021}
+    )
+    cursor.execute(BASELINE_EMPLOYEES_BY_DEPARTMENT)
+    assert report == sorted(cursor.fetchall())
+
+def test_post_employees_increment_the_all_time_totals(cursor):
+    load_hires(cursor)
+    cursor.execute("select department_id, hired from report_total_hires_by_department order by 1")
+    assert cursor.fetchall() == [(1, 5), (2, 5), (3, 2)]
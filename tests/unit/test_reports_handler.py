@@ -0,0 +1,161 @@
+import json
+import base64
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+import pytest
+from psycopg2 import sql
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+reports_handler, database_commons = load_lambda_modules("online", "reports_handler", "database_commons")
+
+ORDER_BY = [("hired", "desc"), ("id", "asc")]
+
+def encode_json(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+def test_page_cursors_round_trip():
+    cursor = reports_handler.encode_page_cursor([12, "Sales"])
+    assert reports_handler.decode_page_cursor(cursor, ORDER_BY) == [12, "Sales"]
+
+@pytest.mark.parametrize("page_cursor", [
+    "not a cursor!",
+    encode_json({"hired": 12, "id": 3}),
+    encode_json([12]),
+    encode_json([12, 3, 4]),
+    encode_json([12, [3]]),
+    encode_json([{"hired": 12}, 3])
+])
+def test_decode_page_cursor_rejects_tampered_cursors(page_cursor):
+    with pytest.raises(AssertionError):
+        reports_handler.decode_page_cursor(page_cursor, ORDER_BY)
+
+def test_parse_page_options_requires_limit_with_cursor():
+    with pytest.raises(AssertionError):
+        reports_handler.parse_page_options({"cursor": reports_handler.encode_page_cursor([1, 2])}, ORDER_BY)
+
+def walk_pages(cursor, query, order_by, limit, filters):
+    """Runs paginate_query page by page with the report filters, like get_report_page"""
+    pages = []
+    cursor_values = None
+    while True:
+        parameters = {**filters, **reports_handler.get_cursor_parameters(cursor_values)}
+        cursor.execute(reports_handler.paginate_query(query, order_by, cursor_values, limit=limit), parameters)
+        page = cursor.fetchall()
+        pages.append(page[:limit])
+        if len(page) <= limit:
+            return pages
+        page_cursor = reports_handler.encode_page_cursor(list(page[limit - 1]))
+        cursor_values = reports_handler.decode_page_cursor(page_cursor, order_by)
+
+def build_rows_query(cursor, rows, columns):
+    """Loads the rows in a temporary table, literals with % could not be inlined in the query either"""
+    cursor.execute(sql.SQL("create temporary table report_rows ({})").format(
+        sql.SQL(", ").join(sql.SQL("{} text").format(sql.Identifier(column)) for column in columns)
+    ))
+    cursor.executemany(
+        sql.SQL("insert into report_rows values ({})").format(sql.SQL(", ").join(sql.Placeholder() * len(columns))),
+        rows
+    )
+    return sql.SQL("select * from report_rows")
+
+def test_keyset_pages_cover_every_row_once(cursor):
+    """Walks a report with ties on the first sort column page by page, needs TEST_DATABASE_URL"""
+    rows = [(hired, row_id) for row_id, hired in enumerate([5, 3, 5, 1, 3, 5, 2, 3, 1, 4], start=1)]
+    query = sql.SQL("select * from (values {}) as report_rows (hired, id)").format(
+        sql.SQL(", ").join(sql.Literal(row) for row in rows)
+    )
+    pages = walk_pages(cursor, query, ORDER_BY, 3, {"year": 2021})
+
+    assert [row for page in pages for row in page] == sorted(rows, key=lambda row: (-row[0], row[1]))
+    assert [len(page) for page in pages] == [3, 3, 3, 1]
+
+def test_keyset_pages_accept_percent_signs_in_cursor_values(cursor):
+    """Cursor values are query parameters, not literals run through %-formatting, needs TEST_DATABASE_URL"""
+    rows = [("100% Remote", "Analyst"), ("%(x)s", "Manager"), ("Sales", "50%"), ("Sales", "Lead %s")]
+    order_by = [("department", "asc"), ("job", "asc")]
+    pages = walk_pages(cursor, build_rows_query(cursor, rows, ["department", "job"]), order_by, 1, {"year": 2021})
+
+    assert [row for page in pages for row in page] == sorted(rows)
+
+UPDATED_AT = datetime(2024, 3, 1, 12, 30, 15, 250000, tzinfo=timezone.utc)
+
+@pytest.fixture
+def served_report(monkeypatch):
+    """Serves /employees_by_department at the data version in the returned dict, counting the queried pages"""
+    state = {"data_version": (1, UPDATED_AT), "queried_pages": 0}
+
+    def get_report_page(report, filters, page_options):
+        state["queried_pages"] += 1
+        return {"body": json.dumps([["Sales", "Analyst", 1, 0, 0, 0]]), "headers": {"Content-Type": "application/json"}}
+
+    monkeypatch.setattr(reports_handler.report_cache, "_memory_cache", OrderedDict())
+    monkeypatch.setattr(reports_handler.report_cache, "REPORTS_CACHE_DIR", None)
+    monkeypatch.setattr(reports_handler, "get_data_version", lambda: state["data_version"])
+    monkeypatch.setattr(reports_handler, "get_report_page", get_report_page)
+    monkeypatch.setattr(reports_handler, "log_pool_metrics", lambda: None)
+    return state
+
+def request_report(headers=None):
+    return reports_handler.run({
+        "resource": "/employees_by_department",
+        "queryStringParameters": {"year": "2021"},
+        "headers": headers or {}
+    }, None)
+
+def test_matching_etag_is_not_modified(served_report):
+    response = request_report()
+    assert response["statusCode"] == 200
+    etag = response["headers"]["ETag"]
+
+    not_modified = request_report({"If-None-Match": f'"other", {etag}'})
+    assert not_modified["statusCode"] == 304 and not_modified["body"] == ""
+    assert not_modified["headers"]["ETag"] == etag
+    assert served_report["queried_pages"] == 1
+
+def test_if_modified_since_is_compared_at_second_precision(served_report):
+    last_modified = request_report()["headers"]["Last-Modified"]
+    assert last_modified == "Fri, 01 Mar 2024 12:30:15 GMT"
+    assert request_report({"If-Modified-Since": last_modified})["statusCode"] == 304
+    assert request_report({"If-Modified-Since": "Fri, 01 Mar 2024 12:30:14 GMT"})["statusCode"] == 200
+    assert request_report({"If-Modified-Since": "not a date"})["statusCode"] == 200
+
+def test_version_bump_invalidates_etag_and_cached_page(served_report):
+    etag = request_report()["headers"]["ETag"]
+    assert request_report()["statusCode"] == 200
+    assert served_report["queried_pages"] == 1
+
+    served_report["data_version"] = (2, datetime(2024, 3, 2, tzinfo=timezone.utc))
+    response = request_report({"If-None-Match": etag})
+    assert response["statusCode"] == 200
+    assert response["headers"]["ETag"] != etag
+    assert served_report["queried_pages"] == 2
+
+def test_missing_data_version_is_a_server_error(monkeypatch):
+    class MissingVersionCursor:
+
+        def execute(self, query, parameters):
+            pass
+
+        def fetchone(self):
+            return None
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+    class MissingVersionConnection(MissingVersionCursor):
+
+        def cursor(self):
+            return MissingVersionCursor()
+
+    monkeypatch.setattr(database_commons, "borrow_db_connection", MissingVersionConnection)
+    monkeypatch.setattr(reports_handler, "log_pool_metrics", lambda: None)
+    with pytest.raises(RuntimeError):
+        database_commons.get_data_version()
+    response = request_report()
+    assert response["statusCode"] == 500
+    assert "sql/002_data_versions.sql" in json.loads(response["body"])["error"]
@@ -0,0 +1,79 @@
+"""Inserts into a scratch Postgres database, needs TEST_DATABASE_URL"""
+import pathlib
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+resource_creation_handler = load_lambda_modules("online", "resource_creation_handler")
+
+REPORT_TOTAL_TABLES = (pathlib.Path(__file__).parents[2] / "sql" / "006_report_total_hires.sql").read_text()
+
+class CountingCursor:
+    """Forwards to the cursor and counts the savepoint rollbacks"""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rollbacks = 0
+
+    def execute(self, query, *args):
+        if query == "rollback to savepoint insert_employees":
+            self.rollbacks += 1
+        return self.cursor.execute(query, *args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+def build_employees(count, bad_indexes=()):
+    # department_id above the integer range makes the database reject the row
+    return [
+        {
+            "index": index,
+            "name": f"employee {index}",
+            "department_id": 2 ** 40 if index in bad_indexes else 1,
+            "job_id": 1
+        }
+        for index in range(count)
+    ]
+
+def test_insert_employees_isolating_failures_inserts_every_valid_row(cursor):
+    cursor.execute(REPORT_TOTAL_TABLES)
+    counting_cursor = CountingCursor(cursor)
+    errors = []
+    inserted = resource_creation_handler.insert_employees_isolating_failures(
+        counting_cursor, build_employees(64, bad_indexes={5, 40}), errors
+    )
+
+    assert inserted == 62
+    assert sorted(error["index"] for error in errors) == [5, 40]
+    assert all("out of range" in error["reason"] for error in errors)
+    # Bisection, not one insert per row
+    assert counting_cursor.rollbacks <= 2 * 7
+    cursor.execute("select count(*) from hired_employees")
+    assert cursor.fetchone()[0] == 62
+    cursor.execute("select hired from report_total_hires_by_department where department_id = 1")
+    assert cursor.fetchone()[0] == 62
+
+def test_insert_employees_isolating_failures_runs_one_insert_without_failures(cursor):
+    cursor.execute(REPORT_TOTAL_TABLES)
+    counting_cursor = CountingCursor(cursor)
+    errors = []
+    inserted = resource_creation_handler.insert_employees_isolating_failures(counting_cursor, build_employees(10), errors)
+    assert inserted == 10
+    assert errors == []
+    assert counting_cursor.rollbacks == 0
+
+def test_split_invalid_employees_reports_non_string_fields():
+    employees = [
+        {"name": "Ana", "department": "Sales", "job": "Analyst"},
+        {"name": "Bob", "department": ["Sales"], "job": "Analyst"},
+        {"name": 7, "department": "Sales", "job": {"id": 1}},
+        {"name": "Cid", "department": "Sales"},
+        "Dee"
+    ]
+    valid_employees, valid_indexes, errors = resource_creation_handler.split_invalid_employees(employees, 10)
+    assert valid_employees == employees[:1] and valid_indexes == [10]
+    assert errors == [
+        {"index": 11, "reason": "Fields must be strings: department"},
+        {"index": 12, "reason": "Fields must be strings: name, job"},
+        {"index": 13, "reason": "Missing fields: job"},
+        {"index": 14, "reason": "The employee must be a JSON object"}
+    ]
@@ -0,0 +1,72 @@
+import io
+
+import pytest
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+source_to_raw = load_lambda_modules("batch", "source_to_raw")
+
+class FakeS3Client:
+    """Serves one source object and keeps the uploaded ones"""
+
+    def __init__(self, body):
+        self.body = body
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.body)}
+
+    def put_object(self, Bucket, Key, Body, ContentType):
+        self.objects[Key] = Body
+
+def copy_in_parts(monkeypatch, body, **options):
+    client = FakeS3Client(body)
+    monkeypatch.setattr(source_to_raw, "get_s3_client", lambda: client)
+    options = {
+        "raw_bucket": "raw-globant-hr",
+        "normalize": False,
+        "source_encoding": "utf-8-sig",
+        "split_threshold_bytes": 10,
+        "part_max_bytes": 20,
+        **options
+    }
+    raw_keys = source_to_raw.copy_csv_in_parts(
+        "globant-hr", "hr/jobs/jobs.csv", "hr/jobs/unprocessed/20240101T000000000Z-jobs.csv", len(body), options
+    )
+    return raw_keys, [client.objects[raw_key] for raw_key in raw_keys]
+
+def test_iter_csv_records_keeps_quoted_line_breaks_in_one_record():
+    lines = source_to_raw.iter_lines(io.BytesIO(b'1,"Data\nEngineer"\n2,Analyst\n3,"a ""quoted"" job"'))
+    assert list(source_to_raw.iter_csv_records(lines)) == [
+        b'1,"Data\nEngineer"\n', b"2,Analyst\n", b'3,"a ""quoted"" job"\n'
+    ]
+
+def test_iter_lines_normalizes_encoding_and_line_endings():
+    stream = io.BytesIO("﻿1,Gestión\r\n2,Ventas\r3,Legal".encode("utf-8"))
+    assert list(source_to_raw.iter_lines(stream, "utf-8-sig")) == [
+        "1,Gestión\n".encode("utf-8"), b"2,Ventas\n", b"3,Legal\n"
+    ]
+
+def test_copy_csv_in_parts_splits_on_record_boundaries(monkeypatch):
+    body = b'1,"Data\nEngineer"\n2,Analyst\n3,Manager\n4,Support\n5,"Sales\nLead"\n'
+    raw_keys, parts = copy_in_parts(monkeypatch, body)
+
+    assert raw_keys == [
+        f"hr/jobs/unprocessed/20240101T000000000Z-jobs-part-{part_number:05d}.csv" for part_number in range(1, 5)
+    ]
+    assert parts == [b'1,"Data\nEngineer"\n', b"2,Analyst\n3,Manager\n", b"4,Support\n", b'5,"Sales\nLead"\n']
+
+def test_copy_csv_in_parts_keeps_the_key_below_the_split_threshold(monkeypatch):
+    raw_keys, parts = copy_in_parts(monkeypatch, b"1,Analyst\n", split_threshold_bytes=1024)
+    assert raw_keys == ["hr/jobs/unprocessed/20240101T000000000Z-jobs.csv"]
+    assert parts == [b"1,Analyst\n"]
+
+@pytest.mark.parametrize("size, normalize, split", [
+    (100, False, False),
+    (2048, False, True),
+    (100, True, True),
+    (10, True, False)
+])
+def test_is_split(size, normalize, split):
+    options = {"split_threshold_bytes": 1024, "part_max_bytes": 64, "normalize": normalize}
+    assert source_to_raw.is_split(size, options) == split
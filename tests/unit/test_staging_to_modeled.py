@@ -0,0 +1,159 @@
+"""Runs staging_to_modeled against a scratch schema, needs TEST_DATABASE_URL"""
+import pathlib
+
+import pytest
+
+from tests.unit.lambda_modules import load_lambda_modules
+
+staging_to_modeled = load_lambda_modules("batch", "staging_to_modeled")
+
+SQL_DIR = pathlib.Path(__file__).parents[2] / "sql"
+# 003 only adds indexes, concurrently, which cannot run in the transaction of the fixture
+SQL_FILES = [
+    "001_report_tables.sql", "002_data_versions.sql", "004_staging_merge_checkpoints.sql",
+    "005_staging_to_modeled_runs.sql", "006_report_total_hires.sql"
+]
+STAGING_SCHEMA = """
+create table staging_departments (id integer, department text);
+create table staging_jobs (id integer, job text);
+create table staging_hired_employees (
+    id integer, name text, hired_datetime timestamp, department_id integer, job_id integer
+);
+"""
+DEPARTMENTS = [(1, "Sales"), (2, "Legal"), (3, "Support")]
+JOBS = [(1, "Analyst"), (2, "Manager")]
+# Ten employees with ids 1 to 10, then two without id that only the last chunk merges
+EMPLOYEES = [
+    (employee_id, f"employee {employee_id}", f"2021-{employee_id:02d}-01", employee_id % 3 + 1, employee_id % 2 + 1)
+    for employee_id in range(1, 11)
+] + [(None, "no id 1", "2021-11-15", 1, 1), (None, "no id 2", "2021-12-15", 2, 2)]
+
+@pytest.fixture
+def connection(connect_to_scratch_schema, monkeypatch):
+    connection = connect_to_scratch_schema()
+    with connection, connection.cursor() as cur:
+        cur.execute(STAGING_SCHEMA)
+        for sql_file in SQL_FILES:
+            cur.execute((SQL_DIR / sql_file).read_text())
+    monkeypatch.setattr(staging_to_modeled, "get_db_connection", lambda event: connect_to_scratch_schema())
+    try:
+        yield connection
+    finally:
+        connection.close()
+
+def load_staging(connection, departments=DEPARTMENTS, jobs=JOBS, employees=EMPLOYEES):
+    with connection, connection.cursor() as cur:
+        cur.executemany("insert into staging_departments values (%s, %s)", departments)
+        cur.executemany("insert into staging_jobs values (%s, %s)", jobs)
+        cur.executemany("insert into staging_hired_employees values (%s, %s, %s, %s, %s)", employees)
+
+def fetch_all(connection, query, parameters=None):
+    with connection, connection.cursor() as cur:
+        cur.execute(query, parameters)
+        return cur.fetchall()
+
+def fetch_one(connection, query, parameters=None):
+    return fetch_all(connection, query, parameters)[0]
+
+def get_chunks(connection, run_id, dataset):
+    return fetch_all(connection, """
+        select after_id, until_id from staging_to_modeled_run_statements
+        where run_id = %s and dataset = %s order by after_id
+    """, (run_id, dataset))
+
+def test_merge_covers_every_chunk_and_cleans_staging(connection):
+    load_staging(connection)
+    report = staging_to_modeled.run({"run_id": "chunks", "chunk_size": 3}, None)
+
+    assert get_chunks(connection, "chunks", "hired_employees") == [(0, 3), (3, 6), (6, 9), (9, 10)]
+    assert report["datasets"]["hired_employees"]["inserted"] == len(EMPLOYEES)
+    assert fetch_one(connection, "select count(*) from hired_employees") == (len(EMPLOYEES),)
+    # Rows without id are merged once, with the last chunk
+    assert fetch_one(connection, "select count(*) from hired_employees where name like 'no id%%'") == (2,)
+    assert fetch_one(connection, "select sum(hired) from report_total_hires_by_department") == (len(EMPLOYEES),)
+    assert fetch_one(connection, "select count(*) from staging_hired_employees") == (0,)
+    assert fetch_one(connection, "select count(*) from staging_merge_checkpoints") == (0,)
+    assert fetch_one(connection, "select status from staging_to_modeled_runs where run_id = 'chunks'") == ("succeeded",)
+
+def fail_on_employees_chunk(monkeypatch, failing_after_id):
+    record_statement = staging_to_modeled.record_statement
+
+    def record_or_fail(cursor, run_id, statement, seconds, **metrics):
+        if statement == "load_hired_employees" and metrics["after_id"] == failing_after_id:
+            raise RuntimeError("Lost the database half way")
+        record_statement(cursor, run_id, statement, seconds, **metrics)
+    monkeypatch.setattr(staging_to_modeled, "record_statement", record_or_fail)
+    return record_statement
+
+def test_resumed_run_neither_merges_rows_twice_nor_skips_any(connection, monkeypatch):
+    load_staging(connection)
+    record_statement = fail_on_employees_chunk(monkeypatch, 3)
+    with pytest.raises(RuntimeError):
+        staging_to_modeled.run({"run_id": "first", "chunk_size": 3}, None)
+    assert fetch_one(connection, "select count(*) from hired_employees") == (3,)
+    assert fetch_one(connection, "select last_id from staging_merge_checkpoints where dataset = 'hired_employees'") == (3,)
+
+    monkeypatch.setattr(staging_to_modeled, "record_statement", record_statement)
+    report = staging_to_modeled.run({"run_id": "second", "chunk_size": 3}, None)
+
+    assert get_chunks(connection, "second", "hired_employees") == [(3, 6), (6, 9), (9, 10)]
+    assert report["datasets"]["hired_employees"]["rows"] == len(EMPLOYEES) - 3
+    assert fetch_all(connection, "select name from hired_employees order by name") == sorted(
+        (employee[1],) for employee in EMPLOYEES
+    )
+    assert fetch_one(connection, "select sum(hired) from report_total_hires_by_department") == (len(EMPLOYEES),)
+    assert fetch_one(connection, "select count(*) from staging_merge_checkpoints") == (0,)
+
+def test_failed_chunk_is_recorded_in_the_run_ledger(connection, monkeypatch):
+    load_staging(connection)
+    fail_on_employees_chunk(monkeypatch, 6)
+
+    with pytest.raises(RuntimeError, match="Lost the database half way"):
+        staging_to_modeled.run({"run_id": "failing", "chunk_size": 3}, None)
+
+    assert fetch_one(connection, "select status, error, finished_at is not null from staging_to_modeled_runs") == (
+        "failed", "Lost the database half way", True
+    )
+    # The chunks committed before the failure keep their statement rows, the failed one left none
+    assert fetch_all(connection, """
+        select statement, after_id, until_id from staging_to_modeled_run_statements
+        where dataset = 'hired_employees' order by after_id
+    """) == [("load_hired_employees", 0, 3), ("load_hired_employees", 3, 6)]
+    assert fetch_one(connection, "select count(*) from staging_to_modeled_run_statements where dataset = 'departments'") == (1,)
+    assert fetch_one(connection, "select count(*) from staging_hired_employees") == (len(EMPLOYEES),)
+
+def test_reloading_the_same_data_changes_nothing(connection):
+    load_staging(connection)
+    staging_to_modeled.run({"run_id": "load"}, None)
+    version = fetch_one(connection, "select version from data_versions where name = 'hired_employees'")
+
+    load_staging(connection)
+    report = staging_to_modeled.run({"run_id": "reload"}, None)
+
+    for dataset in ("departments", "jobs", "hired_employees"):
+        assert report["datasets"][dataset]["inserted"] == 0
+        assert report["datasets"][dataset]["updated"] == 0
+    assert report["datasets"]["departments"]["unchanged"] == len(DEPARTMENTS)
+    assert fetch_one(connection, "select version from data_versions where name = 'hired_employees'") == version
+    assert fetch_one(connection, "select inserted, updated, unchanged from staging_to_modeled_runs where run_id = 'reload'") == (
+        0, 0, len(DEPARTMENTS) + len(JOBS) + len(EMPLOYEES)
+    )
+
+def test_renamed_department_is_the_only_update(connection):
+    load_staging(connection)
+    staging_to_modeled.run({"run_id": "load"}, None)
+    version = fetch_one(connection, "select version from data_versions where name = 'hired_employees'")[0]
+
+    load_staging(connection, departments=[(1, "Sales"), (2, "Legal and Compliance"), (3, "Support")], employees=[])
+    report = staging_to_modeled.run({"run_id": "rename"}, None)
+
+    assert report["datasets"]["departments"] == {**report["datasets"]["departments"], "inserted": 0, "updated": 1}
+    assert report["datasets"]["jobs"]["updated"] == 0
+    assert fetch_one(connection, "select department from departments where id = 2") == ("Legal and Compliance",)
+    assert fetch_one(connection, "select version from data_versions where name = 'hired_employees'") == (version + 1,)
+
+def test_chunk_size_must_be_positive(connection):
+    load_staging(connection)
+    with pytest.raises(ValueError):
+        staging_to_modeled.run({"run_id": "no chunks", "chunk_size": 0}, None)
+    assert fetch_one(connection, "select status from staging_to_modeled_runs where run_id = 'no chunks'") == ("failed",)